@@ -3,149 +3,930 @@ import os
 import sys
 import time
 import gc
+import contextlib
 import logging
+import mmap
 import multiprocessing
+import shutil
+import tempfile
+import hashlib
+import math
+import zlib
 import numpy as np
+import scipy.sparse
+import scipy.stats
 import pandas as pd
-import simnibs
-
-def rankdata_average(data):
-    data = np.asarray(data, dtype=np.float32)
-    sorter = np.argsort(data, axis=1)
-    inv = np.empty_like(sorter, dtype=np.int32)
-    ranks = np.arange(data.shape[1], dtype=np.int32)
-    np.put_along_axis(inv, sorter, ranks, axis=1)
+from threadpoolctl import threadpool_limits
+
+def _rank_average_chunk(data):
+    n = data.shape[1]
+    sorter = np.argsort(data, axis=1, kind='stable')
     dc = np.take_along_axis(data, sorter, axis=1)
-    res = np.diff(dc, axis=1) != 0
-    obs = np.c_[np.ones(dc.shape[0], dtype=bool), res]
-    dense = np.apply_along_axis(np.cumsum, 1, obs)
-    dense = np.take_along_axis(dense, inv, axis=1)
-    len_r = obs.shape[1]
-    nonzero = np.count_nonzero(obs, axis=1)
-    
-    ranks_list = []
-    unique_nonzero = np.unique(nonzero)
-    for nz in unique_nonzero:
-        indices = np.where(nonzero == nz)[0]
-        sub_dense = dense[indices]
-        nz_indices = np.array([np.flatnonzero(row) for row in obs[indices]], dtype=np.int32)
-        _count = np.array([np.concatenate([row, [len_r]]) for row in nz_indices], dtype=np.int32)
-        _result = 0.5 * (np.take_along_axis(_count, sub_dense, axis=1) +
-                         np.take_along_axis(_count, sub_dense - 1, axis=1) + 1)
-        ranks_list.append((indices, _result))
-    final_ranks = np.zeros_like(data, dtype=np.float32)
-    for indices, result in ranks_list:
-        final_ranks[indices] = result
+    positions = np.arange(n, dtype=np.int32)[None, :]
+    # A tie group spans [first, last] in sorted order; every member gets the mean rank of the span.
+    starts = np.ones(dc.shape, dtype=bool)
+    starts[:, 1:] = dc[:, 1:] != dc[:, :-1]
+    ends = np.ones(dc.shape, dtype=bool)
+    ends[:, :-1] = starts[:, 1:]
+    first = np.maximum.accumulate(np.where(starts, positions, 0), axis=1)
+    last = np.minimum.accumulate(np.where(ends, positions, n - 1)[:, ::-1], axis=1)[:, ::-1]
+    ranks = np.empty(dc.shape, dtype=np.float32)
+    np.put_along_axis(ranks, sorter, (first + last).astype(np.float32) * 0.5 + 1, axis=1)
+    return ranks
+
+def rankdata_average(data, chunkSize=65536):
+    # Row-wise average ranks (scipy.stats.rankdata(..., method='average', axis=1)), computed in
+    # chunks of rows so the int/float temporaries stay bounded; also accepts a memmap or a 1-D vector.
+    if np.ndim(data) == 1:
+        return rankdata_average(np.asarray(data)[None, :], chunkSize)[0]
+    final_ranks = np.empty(data.shape, dtype=np.float32)
+    for start in range(0, data.shape[0], chunkSize):
+        end = min(start + chunkSize, data.shape[0])
+        final_ranks[start:end] = _rank_average_chunk(np.asarray(data[start:end], dtype=np.float32))
     return final_ranks
 
-def compute_corr(x, y):
+def center_scale_rows(x):
     x = np.asarray(x, dtype=np.float32)
-    y = np.asarray(y, dtype=np.float32)
-    mx = x.mean(axis=-1, keepdims=True, dtype=np.float32)
-    my = y.mean(axis=-1, keepdims=True, dtype=np.float32)
-    xm = x - mx
-    ym = y - my
-    r_num = np.sum(xm * ym, axis=-1, dtype=np.float32)
-    r_den = np.sqrt(np.sum(xm * xm, axis=-1, dtype=np.float32) *
-                    np.sum(ym * ym, axis=-1, dtype=np.float32))
+    xm = x - x.mean(axis=-1, keepdims=True, dtype=np.float32)
+    norm = np.sqrt(np.sum(xm * xm, axis=-1, keepdims=True, dtype=np.float32))
     with np.errstate(divide='ignore', invalid="ignore"):
-        r = np.divide(r_num, r_den)
-    return r
-
-def spearman_row(npyMatrix, effectSize):
-    npyMatrix = np.asarray(npyMatrix, dtype=np.float32)
-    effectSize = np.asarray(effectSize, dtype=np.float32)
-    rx = rankdata_average(npyMatrix)
-    ry = rankdata_average(effectSize[None, :])
-    return compute_corr(rx, ry)
-
-def runCorrelation(npyMatrix, effectSize, corrType):
-    allCoeffs = spearman_row(npyMatrix, effectSize)
-    allNegLogP = 1  # Placeholder
+        return np.divide(xm, norm)
+
+def prepare_ranked_matrix(npyMatrix):
+    # Ranked, centred and unit-norm rows: a Spearman coefficient is then a plain dot product.
+    return center_scale_rows(rankdata_average(npyMatrix))
+
+def prepare_ranked_effect(effectSize):
+    return center_scale_rows(rankdata_average(np.asarray(effectSize, dtype=np.float32)))
+
+def unit_rows(x):
+    norm = np.sqrt(np.sum(x * x, axis=-1, keepdims=True, dtype=np.float32))
+    with np.errstate(divide='ignore', invalid="ignore"):
+        return np.divide(x, norm)
+
+def pair_signs(x):
+    i, j = np.triu_indices(x.shape[-1], k=1)
+    return np.sign(x[..., i] - x[..., j]).astype(np.float32)
+
+def weighted_moment_rows(x):
+    # Weighted (co)variances are shift invariant, so centring first keeps x and x^2 accurate in float32.
+    xc = x - x.mean(axis=1, keepdims=True, dtype=np.float32)
+    return np.concatenate([xc, xc * xc], axis=1)
+
+# Each statistic turns a chunk of matrix rows into features once ('rows'), turns the effect sizes into
+# per-study items that a permutation reorders ('effect'), and correlates a row chunk with a block of
+# permuted items ('block', items shaped n_perm x n_studies x item_width) using matrix products.
+
+def spearman_rows(chunk):
+    return prepare_ranked_matrix(chunk)
+
+def spearman_effect(effectSize, weights):
+    # Ranking commutes with permutation, so the ranked effect size is ranked once and then permuted.
+    return prepare_ranked_effect(effectSize)[:, None]
+
+def pearson_rows(chunk):
+    return center_scale_rows(chunk)
+
+def pearson_effect(effectSize, weights):
+    return center_scale_rows(effectSize)[:, None]
+
+def dot_block(rows, items):
+    return rows @ items[:, :, 0].T
+
+def kendall_rows(chunk):
+    # tau-b is the cosine between the pair-sign vectors of x and y, hence a GEMM as well.
+    return unit_rows(pair_signs(np.asarray(chunk, dtype=np.float32)))
+
+def kendall_effect(effectSize, weights):
+    return np.asarray(effectSize, dtype=np.float32)[:, None]
+
+def kendall_block(rows, items):
+    return rows @ unit_rows(pair_signs(items[:, :, 0])).T
+
+def weighted_spearman_rows(chunk):
+    return weighted_moment_rows(rankdata_average(chunk))
+
+def weighted_spearman_effect(effectSize, weights):
+    return np.column_stack([rankdata_average(np.asarray(effectSize, dtype=np.float32)), weights]).astype(np.float32)
+
+def weighted_pearson_rows(chunk):
+    return weighted_moment_rows(np.asarray(chunk, dtype=np.float32))
+
+def weighted_pearson_effect(effectSize, weights):
+    return np.column_stack([effectSize, weights]).astype(np.float32)
+
+def weighted_block(rows, items):
+    # A study's inverse-variance weight travels with its effect size, so the weighted means change with
+    # every permutation; the weighted moments of x still come from three GEMMs per block.
+    n = items.shape[1]
+    y = items[:, :, 0]
+    u = items[:, :, 1] / items[:, :, 1].sum(axis=1, keepdims=True)
+    mean_y = np.sum(u * y, axis=1)
+    var_y = np.sum(u * y * y, axis=1) - mean_y ** 2
+    x, x2 = rows[:, :n], rows[:, n:]
+    mean_x = x @ u.T
+    var_x = np.maximum(x2 @ u.T - mean_x ** 2, 0.0)
+    cov = x @ (u * y).T - mean_x * mean_y[None, :]
+    with np.errstate(divide='ignore', invalid="ignore"):
+        return (cov / np.sqrt(var_x * var_y[None, :])).astype(np.float32)
+
+def tail_probability(stat, dist, alternative='greater'):
+    if alternative == 'greater':
+        return dist.sf(stat)
+    if alternative == 'less':
+        return dist.cdf(stat)
+    if alternative == 'two-sided':
+        return np.minimum(2 * dist.sf(np.abs(stat)), 1.0)
+    raise ValueError(f"Unknown alternative '{alternative}'")
+
+def t_test_pvalues(r, n, alternative='greater'):
+    # Exact for Pearson under normality; the usual large-sample approximation for Spearman.
+    r = np.clip(np.asarray(r, dtype=np.float64), -1.0, 1.0)
+    with np.errstate(divide='ignore', invalid="ignore"):
+        t = r * np.sqrt((n - 2) / ((1.0 - r) * (1.0 + r)))
+    return tail_probability(t, scipy.stats.t(n - 2), alternative)
+
+def kendall_pvalues(tau, n, alternative='greater'):
+    # Normal approximation without tie correction.
+    z = 3.0 * np.asarray(tau, dtype=np.float64) * np.sqrt(n * (n - 1)) / np.sqrt(2.0 * (2 * n + 5))
+    return tail_probability(z, scipy.stats.norm(), alternative)
+
+STATISTICS = {
+    'SpearmanRow': {'rows': spearman_rows, 'effect': spearman_effect, 'block': dot_block,
+                    'n_features': lambda n: n, 'analytic': t_test_pvalues, 'weighted': False},
+    'PearsonRow': {'rows': pearson_rows, 'effect': pearson_effect, 'block': dot_block,
+                   'n_features': lambda n: n, 'analytic': t_test_pvalues, 'weighted': False},
+    'KendallRow': {'rows': kendall_rows, 'effect': kendall_effect, 'block': kendall_block,
+                   'n_features': lambda n: n * (n - 1) // 2, 'analytic': kendall_pvalues, 'weighted': False},
+    'WeightedSpearmanRow': {'rows': weighted_spearman_rows, 'effect': weighted_spearman_effect, 'block': weighted_block,
+                            'n_features': lambda n: 2 * n, 'analytic': None, 'weighted': True},
+    'WeightedPearsonRow': {'rows': weighted_pearson_rows, 'effect': weighted_pearson_effect, 'block': weighted_block,
+                           'n_features': lambda n: 2 * n, 'analytic': None, 'weighted': True},
+}
+
+def get_statistic(corrType):
+    if corrType not in STATISTICS:
+        raise ValueError(f"Unknown correlation type '{corrType}'. Available: {', '.join(STATISTICS)}")
+    return STATISTICS[corrType]
+
+def prepare_effect_items(effectSize, corrType, weights=None):
+    statistic = get_statistic(corrType)
+    if statistic['weighted'] and weights is None:
+        raise ValueError(f"{corrType} needs per-study inverse-variance weights")
+    return statistic['effect'](np.asarray(effectSize, dtype=np.float32), weights)
+
+def correlate_block(corrType, rx_features, effect_items, perm_idx):
+    return STATISTICS[corrType]['block'](rx_features, effect_items[perm_idx])
+
+def transform_to_memmap(matrices, rx_path, corrType, effect_items, rowChunk=65536):
+    # Streams row blocks of (possibly memmapped) matrices through the row transform and the observed
+    # statistic, so only rowChunk rows are ever resident at once. Several matrices over the same studies
+    # are stacked one below the other into a single feature matrix.
+    statistic = get_statistic(corrType)
+    num_rows = sum(m.shape[0] for m in matrices)
+    rx_features = np.lib.format.open_memmap(rx_path, mode='w+', dtype=np.float32,
+                                            shape=(num_rows, statistic['n_features'](matrices[0].shape[1])))
+    observed = np.empty(num_rows, dtype=np.float32)
+    offset = 0
+    for npyMatrix in matrices:
+        if npyMatrix.shape[1] != matrices[0].shape[1]:
+            raise ValueError("All matrices must have one column per study, in the same order")
+        for row_start in range(0, npyMatrix.shape[0], rowChunk):
+            row_end = min(row_start + rowChunk, npyMatrix.shape[0])
+            chunk = statistic['rows'](np.asarray(npyMatrix[row_start:row_end], dtype=np.float32))
+            rx_features[offset + row_start:offset + row_end] = chunk
+            observed[offset + row_start:offset + row_end] = statistic['block'](chunk, effect_items[None, :, :])[:, 0]
+        offset += npyMatrix.shape[0]
+    rx_features.flush()
+    del rx_features
+    return observed
+
+def effect_size_variance(df):
+    # Sampling variance of Hedges' g from the group sizes, as in runMetaanalysis.compute_effect_size.
+    n_tdcs = df['Number tDSC'].astype(float)
+    n_sham = df['Number Sham'].astype(float)
+    J = 1 - (3 / (4 * (n_tdcs + n_sham) - 9))
+    d = df['fixedG'].astype(float) / J
+    variance_d = (n_tdcs + n_sham) / (n_tdcs * n_sham) + (d ** 2) / (2 * (n_tdcs + n_sham))
+    return variance_d * (J ** 2)
+
+def row_means(npyMatrix, rowChunk=65536):
+    means = np.empty(npyMatrix.shape[0], dtype=np.float32)
+    for row_start in range(0, npyMatrix.shape[0], rowChunk):
+        row_end = min(row_start + rowChunk, npyMatrix.shape[0])
+        means[row_start:row_end] = np.mean(np.asarray(npyMatrix[row_start:row_end], dtype=np.float32), axis=1)
+    return means
+
+def permutation_block(n_items, n_perm, seed, stream_key, block_index):
+    # Every block draws from its own SeedSequence child, so the permutations depend only on
+    # (seed, stream_key, block_index) and never on which worker or in which order it runs.
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(stream_key, block_index)))
+    return rng.permuted(np.tile(np.arange(n_items), (n_perm, 1)), axis=1)
+
+def stream_key_for(name):
+    return zlib.crc32(name.encode('utf-8'))
+
+def count_rank_patterns(effect_items):
+    # Distinct orderings of the (possibly tied) effect items: n! / prod(m_i!).
+    _, group_sizes = np.unique(effect_items, axis=0, return_counts=True)
+    n_patterns = math.factorial(int(group_sizes.sum()))
+    for m in group_sizes:
+        n_patterns //= math.factorial(int(m))
+    return n_patterns
+
+def exact_pattern_weight(effect_items):
+    # Number of raw permutations collapsing onto each distinct pattern (the same for all of them).
+    _, group_sizes = np.unique(effect_items, axis=0, return_counts=True)
+    return int(np.prod([math.factorial(int(m)) for m in group_sizes]))
+
+def _multinomial(group_counts):
+    total = math.factorial(sum(group_counts))
+    for c in group_counts:
+        total //= math.factorial(c)
+    return total
+
+def _unrank_pattern(k, group_counts):
+    group_counts = list(group_counts)
+    labels = []
+    for _ in range(sum(group_counts)):
+        for g in range(len(group_counts)):
+            if group_counts[g] == 0:
+                continue
+            group_counts[g] -= 1
+            n_below = _multinomial(group_counts)
+            if k < n_below:
+                labels.append(g)
+                break
+            k -= n_below
+            group_counts[g] += 1
+    return labels
+
+def _next_pattern(labels):
+    i = len(labels) - 2
+    while i >= 0 and labels[i] >= labels[i + 1]:
+        i -= 1
+    if i < 0:
+        return False
+    j = len(labels) - 1
+    while labels[j] <= labels[i]:
+        j -= 1
+    labels[i], labels[j] = labels[j], labels[i]
+    labels[i + 1:] = reversed(labels[i + 1:])
+    return True
+
+def exact_permutation_block(effect_items, start, n_perm):
+    # Patterns are enumerated in lexicographic order of tie-group labels; unranking the first
+    # pattern of the block lets any worker build any block without walking the ones before it.
+    values, first_index, group_labels = np.unique(effect_items, axis=0, return_index=True, return_inverse=True)
+    group_labels = group_labels.reshape(-1)
+    group_counts = np.bincount(group_labels, minlength=values.shape[0]).tolist()
+    labels = _unrank_pattern(start, group_counts)
+    patterns = np.empty((n_perm, len(labels)), dtype=np.int64)
+    for b in range(n_perm):
+        patterns[b] = labels
+        _next_pattern(labels)
+    # Any member of a tie group carries the same item, so one representative index per group suffices.
+    return first_index[patterns]
+
+def compute_statistic(npyMatrix, effectSize, corrType, weights=None, rowChunk=65536):
+    statistic = get_statistic(corrType)
+    effect_items = prepare_effect_items(effectSize, corrType, weights)
+    coeffs = np.empty(npyMatrix.shape[0], dtype=np.float32)
+    for row_start in range(0, npyMatrix.shape[0], rowChunk):
+        row_end = min(row_start + rowChunk, npyMatrix.shape[0])
+        chunk = statistic['rows'](np.asarray(npyMatrix[row_start:row_end], dtype=np.float32))
+        coeffs[row_start:row_end] = statistic['block'](chunk, effect_items[None, :, :])[:, 0]
+    return coeffs
+
+def spearman_row(npyMatrix, effectSize, rowChunk=65536):
+    return compute_statistic(npyMatrix, effectSize, 'SpearmanRow', rowChunk=rowChunk)
+
+def runCorrelation(npyMatrix, effectSize, corrType, weights=None, alternative='greater', rowChunk=65536):
+    # Permutation-free fast path: coefficients plus analytic -log10 p-values where the statistic has them.
+    allCoeffs = compute_statistic(npyMatrix, effectSize, corrType, weights, rowChunk)
+    analytic = get_statistic(corrType)['analytic']
+    if analytic is None:
+        return allCoeffs, None
+    p_values = analytic(allCoeffs, npyMatrix.shape[1], alternative)
+    allNegLogP = -np.log10(np.clip(p_values, 1e-10, None)).astype(np.float32)
     return allCoeffs, allNegLogP
 
+# Null coefficients equal to the observed one can differ from it by float32 rounding between
+# GEMV and GEMM kernels; they still have to count as exceedances.
+EXCEEDANCE_TOL = 1e-6
+
+def count_exceedances(observed, block, alternative='greater'):
+    observed = observed[:, None]
+    with np.errstate(invalid='ignore'):
+        if alternative == 'greater':
+            hits = block >= observed - EXCEEDANCE_TOL
+        elif alternative == 'less':
+            hits = block <= observed + EXCEEDANCE_TOL
+        elif alternative == 'two-sided':
+            hits = np.abs(block) >= np.abs(observed) - EXCEEDANCE_TOL
+        else:
+            raise ValueError(f"Unknown alternative '{alternative}'")
+    return np.count_nonzero(hits, axis=1).astype(np.int32)
+
+def orient_statistic(x, alternative='greater'):
+    # Maps a coefficient onto the scale on which large values are extreme for the chosen test.
+    if alternative == 'greater':
+        return x
+    if alternative == 'less':
+        return -x
+    if alternative == 'two-sided':
+        return np.abs(x)
+    raise ValueError(f"Unknown alternative '{alternative}'")
+
+def supra_critical_value(corrType, n_studies, threshold, alternative='greater'):
+    # Oriented statistic whose analytic p-value is 10^-threshold. The cut-off is the same for every vertex
+    # and every permutation, so the supra-threshold sets of a permutation are comparable across subjects.
+    analytic = get_statistic(corrType)['analytic']
+    sign = -1.0 if alternative == 'less' else 1.0
+    target = 10.0 ** -threshold
+    low, high = (0.0 if alternative == 'two-sided' else -1.0), 1.0
+    for _ in range(60):
+        mid = 0.5 * (low + high)
+        if analytic(np.float64(sign * mid), n_studies, alternative) > target:
+            low = mid
+        else:
+            high = mid
+    return np.float32(high)
+
+def write_supra_block(path, masks):
+    # Supra-threshold masks of one permutation block: one row of bits per permutation, packed over all rows.
+    tmp_path = path[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_path, np.ascontiguousarray(masks.T))
+    os.replace(tmp_path, path)
+
+def assemble_supra_masks(supra_dir, num_rows, num_blocks, blockSize, nPermutations):
+    # Concatenates the block parts into one permutations x ceil(rows / 8) bit matrix on disk:
+    # np.unpackbits(masks[b], count=rows) is the supra-threshold mask of permutation b.
+    masks_path = os.path.join(supra_dir, 'masks.npy')
+    masks = np.lib.format.open_memmap(masks_path, mode='w+', dtype=np.uint8, shape=(nPermutations, (int(num_rows) + 7) // 8))
+    for b in range(num_blocks):
+        part = np.load(os.path.join(supra_dir, f'block_{b}.npy'))
+        masks[b * blockSize:b * blockSize + part.shape[0]] = part
+    masks.flush()
+    del masks
+    return masks_path
+
+def permutation_key(effect_items, nPermutations, blockSize, seed, streamKey, exact):
+    # Identifies the permutations themselves: subjects sharing it saw the same permuted effect sizes.
+    h = hashlib.sha1(f'{nPermutations}|{blockSize}|{seed}|{streamKey}|{exact}'.encode('utf-8'))
+    h.update(np.ascontiguousarray(effect_items).tobytes())
+    return h.hexdigest()
+
+def top_values(x, k):
+    if x.shape[1] <= k:
+        return x
+    return np.partition(x, x.shape[1] - k, axis=1)[:, x.shape[1] - k:]
+
+def gpd_survival(y, shape, scale):
+    z = y / scale
+    near_exponential = np.abs(shape) < 1e-8
+    safe_shape = np.where(near_exponential, 1.0, shape)
+    power = np.maximum(1.0 + safe_shape * z, 0.0) ** (-1.0 / safe_shape)
+    return np.where(near_exponential, np.exp(-z), power)
+
+def gpd_tail_pvalues(observed, top, nPermutations):
+    # Knijnenburg et al. (2009): the nExc largest null values are modelled as a generalized Pareto
+    # distribution above a threshold halfway between the nExc-th and (nExc+1)-th order statistic,
+    # fitted by probability-weighted moments (Hosking & Wallis 1987), which vectorises over vertices.
+    top = -np.sort(-top.astype(np.float64), axis=1)
+    n_exc = top.shape[1] - 1
+    threshold = 0.5 * (top[:, n_exc - 1] + top[:, n_exc])
+    y = np.sort(top[:, :n_exc] - threshold[:, None], axis=1)
+    plotting = (np.arange(1, n_exc + 1) - 0.35) / n_exc
+    a0 = y.mean(axis=1)
+    a1 = np.mean((1.0 - plotting)[None, :] * y, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        shape = 2.0 - a0 / (a0 - 2.0 * a1)
+        scale = 2.0 * a0 * a1 / (a0 - 2.0 * a1)
+        p_values = (n_exc / nPermutations) * gpd_survival(np.maximum(observed - threshold, 0.0), shape, scale)
+        # Anderson-Darling statistic of the fitted exceedances, exported as the fit diagnostic.
+        cdf = np.clip(1.0 - gpd_survival(y, shape[:, None], scale[:, None]), 1e-12, 1.0 - 1e-12)
+        weights = 2.0 * np.arange(1, n_exc + 1) - 1.0
+        ad = -n_exc - np.mean(weights[None, :] * (np.log(cdf) + np.log(1.0 - cdf[:, ::-1])), axis=1)
+        # A negative shape bounds the fitted tail at threshold - scale / shape. Observed values at or beyond
+        # that endpoint get a zero tail probability the null sample cannot support; they keep the empirical p.
+        within_support = (shape >= 0) | (observed - threshold < -scale / shape)
+    valid = np.isfinite(p_values) & (p_values > 0) & np.isfinite(shape) & (scale > 0) & within_support
+    return p_values, shape, scale, ad, valid
+
+# Thread-count variables of the BLAS and OpenMP runtimes numpy may be linked against.
+BLAS_THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+                         'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+# Read-only state set up once per pool by init_worker; tasks then carry only block numbers and view paths.
+_shared = {}
+
+def publish_array(path, array):
+    np.save(path, np.ascontiguousarray(array))
+    return path
+
+def pin_blas_threads(n_threads):
+    # The environment covers processes started afterwards, which read it when they load numpy; the pools
+    # already running in this process, inherited from the parent under fork, are limited by threadpoolctl.
+    os.environ.update({name: str(n_threads) for name in BLAS_THREAD_VARIABLES})
+    threadpool_limits(n_threads)
+
+@contextlib.contextmanager
+def worker_blas_environment(n_threads):
+    # Workers started with spawn read their BLAS thread count from the environment when they import numpy,
+    # so they never start more threads; forked workers inherit the parent's loaded BLAS, which init_worker
+    # pins. The caller's own values are restored once the pool has started them.
+    saved = {name: os.environ.get(name) for name in BLAS_THREAD_VARIABLES}
+    os.environ.update({name: str(n_threads) for name in BLAS_THREAD_VARIABLES})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def init_worker(effect_items, settings):
+    # Every worker is one core of the budget: a multi-threaded GEMM per worker would oversubscribe it.
+    pin_blas_threads(1)
+    _shared.update(settings)
+    _shared['effect_items'] = effect_items
+    _shared['view'] = None
+    _shared['null'] = np.load(settings['null_path'], mmap_mode='r+') if settings['null_path'] is not None else None
+
+def load_view(view):
+    # A view is (rx_path, observed_path, rows_path, segments_path): the published feature rows plus, in
+    # adaptive mode, the positions of the still-active rows inside them, and with several variants the
+    # variant of every published row. Workers keep only the latest one mapped.
+    if _shared['view'] != view:
+        rx_path, observed_path, rows_path, segments_path = view
+        _shared['rx_features'] = np.load(rx_path, mmap_mode='r')
+        _shared['observed'] = np.load(observed_path, mmap_mode='r')
+        _shared['rows'] = np.load(rows_path) if rows_path is not None else None
+        _shared['segments'] = np.load(segments_path) if segments_path is not None else None
+        _shared['view'] = view
+    return _shared['rx_features'], _shared['observed'], _shared['rows'], _shared['segments']
+
+def update_extremes(block_max, block_min, block):
+    with np.errstate(invalid='ignore'):
+        np.fmax(block_max, np.nanmax(block, axis=0, initial=-np.inf), out=block_max)
+        np.fmin(block_min, np.nanmin(block, axis=0, initial=np.inf), out=block_min)
+
 def worker(task):
+    block_index, block_start, n_perm, view, tail_size = task
     try:
-        start_time = time.time()
-        currMatrix, currEffectSize, whichCorrelation, i = task
-        shuffled_effect_size = np.random.permutation(currEffectSize)  
-        currCoeffs, _ = runCorrelation(currMatrix, shuffled_effect_size, whichCorrelation)  
+        rx_features, observed, rows, segments = load_view(view)
+        # The tail pass replays blocks the main pass already dumped, on a compacted view whose row
+        # numbers are not those of the dump.
+        null = _shared['null'] if not tail_size else None
+        row_chunk = _shared['row_chunk']
+        if _shared['exact']:
+            perm_idx = exact_permutation_block(_shared['effect_items'], block_start, n_perm)
+        else:
+            perm_idx = permutation_block(_shared['effect_items'].shape[0], n_perm, _shared['seed'], _shared['stream_key'], block_index)
+        num_rows = rx_features.shape[0] if rows is None else rows.shape[0]
+        counts = np.empty(num_rows, dtype=np.int32)
+        top = np.empty((num_rows, min(tail_size, n_perm)), dtype=np.float32) if tail_size else None
+        block_max = np.full((_shared['n_segments'], n_perm), -np.inf, dtype=np.float32)
+        block_min = np.full((_shared['n_segments'], n_perm), np.inf, dtype=np.float32)
+        # Supra-threshold sets are kept in the main pass only, for the rows of the first matrix.
+        supra = _shared['supra_dir'] is not None and rows is None and not tail_size
+        supra_rows = _shared['supra_rows']
+        # Row chunks start at multiples of 8 (see _run_permutations), so they pack into whole bytes.
+        supra_masks = np.empty(((supra_rows + 7) // 8, n_perm), dtype=np.uint8) if supra else None
+        for row_start in range(0, num_rows, row_chunk):
+            row_end = min(row_start + row_chunk, num_rows)
+            if rows is None:
+                chunk_rows = slice(row_start, row_end)
+            else:
+                chunk_rows = rows[row_start:row_end]
+            block = correlate_block(_shared['statistic'], rx_features[chunk_rows], _shared['effect_items'], perm_idx)
+            counts[row_start:row_end] = count_exceedances(observed[chunk_rows], block, _shared['alternative'])
+            if segments is None:
+                update_extremes(block_max[0], block_min[0], block)
+            else:
+                # Each variant keeps its own max-statistic null.
+                chunk_segments = segments[chunk_rows]
+                for segment in np.unique(chunk_segments):
+                    in_segment = chunk_segments == segment
+                    update_extremes(block_max[segment], block_min[segment], block[in_segment])
+            if top is not None:
+                top[row_start:row_end] = top_values(orient_statistic(block, _shared['alternative']), tail_size)
+            if supra and row_start < supra_rows:
+                supra_end = min(row_end, supra_rows)
+                supra_masks[row_start // 8:(supra_end + 7) // 8] = np.packbits(
+                    orient_statistic(block[:supra_end - row_start], _shared['alternative']) > _shared['supra_critical'], axis=0)
+            if null is not None:
+                null[chunk_rows, block_start:block_start + block.shape[1]] = block
+        if null is not None:
+            null.flush()
+        if supra:
+            write_supra_block(os.path.join(_shared['supra_dir'], f'block_{block_index}.npy'), supra_masks)
     except Exception as e:
-        logging.error(f"Error processing task {i}: {e}", exc_info=True)
-        return np.zeros((currMatrix.shape[0], 1), dtype=np.float32)
-    return currCoeffs.reshape(-1, 1)
-
-def parallel_process(currMatrix, currEffectSize, whichCorrelation, nPermutations, batchSize, saveToPath, n_cores):
-    tasks = [(currMatrix, currEffectSize, whichCorrelation, i) for i in range(nPermutations)]
-    num_batches = (nPermutations + batchSize - 1) // batchSize
-
-    sample_result = worker(tasks[0])
-    num_rows = sample_result.shape[0]
-    num_cols = nPermutations
-    mmap_file = np.lib.format.open_memmap(
-        saveToPath,
-        mode='w+',
-        dtype=np.float32,
-        shape=(num_rows, num_cols)
-    )
-
-    with multiprocessing.Pool(n_cores) as pool:
-        for i in range(num_batches):
-            batch_start = i * batchSize
-            batch_end = min((i + 1) * batchSize, nPermutations)
-            batch = tasks[batch_start:batch_end]
-            batch_results = pool.map(worker, batch)
-            batch_results_array = np.concatenate(batch_results, axis=1)
-            mmap_file[:, batch_start:batch_end] = batch_results_array
-            mmap_file.flush()
-            del batch_results
-            del batch_results_array
-            gc.collect()
-            print(f'Batch {i + 1} completed and saved to disk')
-
-    pool.close()
-    pool.join()
-    del mmap_file
-    gc.collect()
-    return
-
-def read_mmap_file_and_compute_pvalues(mmap_file_path, original_values, batchSize):
-    mmap_file = np.load(mmap_file_path, mmap_mode='r')
-    num_rows, num_cols = mmap_file.shape
-    p_values = np.empty(num_rows, dtype=np.float32)
-    for start_row in range(0, num_rows, batchSize):
-        end_row = min(start_row + batchSize, num_rows)
-        batch = mmap_file[start_row:end_row, :]
-        print(f'Processing rows {start_row} to {end_row}')
-        for i in range(batch.shape[0]):
-            orig_value = original_values[start_row + i]
-            p_value = np.sum(batch[i, :] >= orig_value) / num_cols
-            p_values[start_row + i] = p_value
-        del batch
+        logging.error(f"Error processing permutation block {block_index}: {e}", exc_info=True)
+        raise
+    return block_index, counts, block_max, block_min, top
+
+def run_fingerprint(observed, effect_items):
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(observed).tobytes())
+    h.update(np.ascontiguousarray(effect_items).tobytes())
+    return h.hexdigest()
+
+def save_checkpoint(checkpointPath, config, done_blocks, exceedances, n_drawn, perm_max, perm_min):
+    tmp_path = checkpointPath + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, done_blocks=done_blocks, exceedances=exceedances, n_drawn=n_drawn, perm_max=perm_max, perm_min=perm_min,
+                 **{k: np.asarray(v) for k, v in config.items()})
+    os.replace(tmp_path, checkpointPath)
+
+def load_checkpoint(checkpointPath, config, num_blocks, num_rows):
+    if checkpointPath is None or not os.path.exists(checkpointPath):
+        return None
+    with np.load(checkpointPath) as ckpt:
+        for key, value in config.items():
+            if key not in ckpt or ckpt[key].item() != value:
+                print(f"Checkpoint {checkpointPath} was written for a different run ({key} differs). Starting over.")
+                return None
+        done_blocks = ckpt['done_blocks']
+        exceedances = ckpt['exceedances']
+        n_drawn = ckpt['n_drawn']
+        perm_max = ckpt['perm_max']
+        perm_min = ckpt['perm_min']
+    if done_blocks.shape[0] != num_blocks or exceedances.shape[0] != num_rows:
+        print(f"Checkpoint {checkpointPath} does not match the current run. Starting over.")
+        return None
+    return done_blocks, exceedances, n_drawn, perm_max, perm_min
+
+def maxstat_pvalues(observed, perm_max, perm_min, alternative='greater'):
+    # Westfall-Young single-step adjustment: compare each vertex with the null distribution
+    # of the most extreme statistic over all vertices, which controls the FWER under any
+    # spatial dependence.
+    if alternative == 'greater':
+        null_extreme, stat = perm_max, observed
+    elif alternative == 'less':
+        null_extreme, stat = -perm_min, -observed
+    elif alternative == 'two-sided':
+        null_extreme, stat = np.fmax(np.abs(perm_max), np.abs(perm_min)), np.abs(observed)
+    else:
+        raise ValueError(f"Unknown alternative '{alternative}'")
+    null_sorted = np.sort(null_extreme)
+    counts = null_sorted.shape[0] - np.searchsorted(null_sorted, stat - EXCEEDANCE_TOL, side='left')
+    return (counts / null_sorted.shape[0]).astype(np.float32)
+
+def publish_view(shared_dir, tag, view, observed, row_segments, published_rows, active_rows, compactFraction, rowChunk):
+    # Compacts the published matrix to the active rows once they fall below compactFraction of it,
+    # otherwise only publishes the active positions inside the current copy.
+    rx_source = np.load(view[0], mmap_mode='r')
+    if active_rows.shape[0] > compactFraction * published_rows.shape[0]:
+        local_rows = np.searchsorted(published_rows, active_rows).astype(np.int64)
+        rows_path = publish_array(os.path.join(shared_dir, f'rows_{tag}.npy'), local_rows)
+        return published_rows, (view[0], view[1], rows_path, view[3])
+    rx_path = os.path.join(shared_dir, f'rx_features_{tag}.npy')
+    local_rows = np.searchsorted(published_rows, active_rows)
+    compacted = np.lib.format.open_memmap(rx_path, mode='w+', dtype=np.float32, shape=(active_rows.shape[0], rx_source.shape[1]))
+    for row_start in range(0, active_rows.shape[0], rowChunk):
+        row_end = min(row_start + rowChunk, active_rows.shape[0])
+        compacted[row_start:row_end] = rx_source[local_rows[row_start:row_end]]
+    compacted.flush()
+    del compacted
+    observed_path = publish_array(os.path.join(shared_dir, f'observed_{tag}.npy'), observed[active_rows])
+    segments_path = None
+    if row_segments is not None:
+        segments_path = publish_array(os.path.join(shared_dir, f'segments_{tag}.npy'), row_segments[active_rows])
+    return active_rows, (rx_path, observed_path, None, segments_path)
+
+def parallel_process(currMatrix, currEffectSize, whichCorrelation, nPermutations, batchSize, n_cores, workDir,
+                     alternative='greater', nullDumpPath=None, blockSize=64, rowChunk=65536,
+                     seed=0, streamKey=0, checkpointPath=None, exactLimit=0,
+                     adaptiveExceedances=0, compactFraction=0.5, tailFitSize=0, tailMinExceedances=10, weights=None,
+                     supraThreshold=0, supraDir=None):
+    # The transformed matrix is published once as a read-only memmap instead of being pickled into every
+    # task; it is built chunk by chunk, so currMatrix itself may be a memmap larger than RAM.
+    # currMatrix may also be a list of matrices over the same studies (the base, fsavg_overlays and
+    # subject_overlays variants of one type): they are then analysed in one pass over the same permutations,
+    # and one result dict is returned per matrix.
+    # With supraThreshold > 0 and a supraDir, every permutation's set of vertices beyond the analytic
+    # 10^-supraThreshold cut-off is kept as well for the first matrix, as a bit mask: rows / 8 bytes per
+    # permutation, 625 MB for 1M rows and 5000 permutations. supraDir holds the block parts across restarts.
+    if 0 < tailFitSize < tailMinExceedances:
+        # The fit threshold would fall below observed values that up to tailMinExceedances null values exceed.
+        raise ValueError("tailFitSize must be at least tailMinExceedances")
+    joint = isinstance(currMatrix, (list, tuple))
+    matrices = list(currMatrix) if joint else [currMatrix]
+    shared_dir = tempfile.mkdtemp(prefix='perm_shared_', dir=workDir)
+    try:
+        results = _run_permutations(matrices, currEffectSize, whichCorrelation, nPermutations, batchSize, n_cores, shared_dir,
+                                    alternative, nullDumpPath, blockSize, rowChunk, seed, streamKey, checkpointPath, exactLimit,
+                                    adaptiveExceedances, compactFraction, tailFitSize, tailMinExceedances, weights,
+                                    supraThreshold, supraDir)
+        return results if joint else results[0]
+    finally:
         gc.collect()
-    del mmap_file
-    gc.collect()
-    return p_values
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+def _run_permutations(matrices, currEffectSize, whichCorrelation, nPermutations, batchSize, n_cores, shared_dir,
+                      alternative, nullDumpPath, blockSize, rowChunk, seed, streamKey, checkpointPath, exactLimit,
+                      adaptiveExceedances, compactFraction, tailFitSize, tailMinExceedances, weights,
+                      supraThreshold=0, supraDir=None):
+    effect_items = prepare_effect_items(currEffectSize, whichCorrelation, weights)
+    rx_path = os.path.join(shared_dir, 'rx_features.npy')
+    observed = transform_to_memmap(matrices, rx_path, whichCorrelation, effect_items, rowChunk)
+    observed_path = publish_array(os.path.join(shared_dir, 'observed.npy'), observed)
+    num_rows = observed.shape[0]
+    segment_rows = [m.shape[0] for m in matrices]
+    segment_starts = np.cumsum([0] + segment_rows)
+    n_segments = len(matrices)
+    row_segments = None
+    segments_path = None
+    if n_segments > 1:
+        row_segments = np.repeat(np.arange(n_segments, dtype=np.int32), segment_rows)
+        segments_path = publish_array(os.path.join(shared_dir, 'segments.npy'), row_segments)
+    n_patterns = count_rank_patterns(effect_items)
+    exact = n_patterns <= exactLimit
+    if exact:
+        # Few enough distinct rank patterns: enumerate all of them instead of sampling.
+        nPermutations = n_patterns
+        print(f"Exact permutation mode: {n_patterns} distinct rank patterns, "
+              f"each standing for {exact_pattern_weight(effect_items)} equivalent permutations")
+    # Besag-Clifford sequential stopping: a vertex leaves the active set once it has collected
+    # adaptiveExceedances exceedances. Lexicographic enumeration is not a random order, so exact
+    # mode always runs to the end.
+    adaptive = adaptiveExceedances > 0 and not exact
+    if adaptive and nullDumpPath is not None:
+        raise ValueError("The full null dump is not available with adaptive stopping")
+    supra_critical = None
+    if supraThreshold > 0 and supraDir is not None:
+        if adaptive:
+            print("Supra-threshold sets are not kept with adaptive stopping: stopped vertices leave the null")
+        elif get_statistic(whichCorrelation)['analytic'] is None:
+            print(f"Supra-threshold sets are not kept for {whichCorrelation}: it has no analytic p-value to "
+                  f"derive the cut-off from")
+        else:
+            # Whole bytes of the packed masks per row chunk.
+            rowChunk = (rowChunk + 7) // 8 * 8
+            supra_critical = supra_critical_value(whichCorrelation, len(currEffectSize), supraThreshold, alternative)
+    # Blocks have a fixed size independent of n_cores, so results are identical for any worker count.
+    num_blocks = (nPermutations + blockSize - 1) // blockSize
+    blocks_per_batch = max(1, batchSize // blockSize)
+
+    config = {
+        'statistic': whichCorrelation,
+        'alternative': alternative,
+        'n_permutations': nPermutations,
+        'block_size': blockSize,
+        'seed': seed,
+        'stream_key': streamKey,
+        'exact': exact,
+        'adaptive_exceedances': adaptiveExceedances if adaptive else 0,
+        'batch_blocks': blocks_per_batch if adaptive else 0,
+        'segment_rows': ','.join(str(n) for n in segment_rows),
+        'fingerprint': run_fingerprint(observed, effect_items),
+        'supra_critical': f'{supra_critical:.9g}' if supra_critical is not None else '',
+    }
+    done_blocks = np.zeros(num_blocks, dtype=bool)
+    exceedances = np.zeros(num_rows, dtype=np.int64)
+    n_drawn = np.zeros(num_rows, dtype=np.int64)
+    perm_max = np.full((n_segments, nPermutations), np.nan, dtype=np.float32)
+    perm_min = np.full((n_segments, nPermutations), np.nan, dtype=np.float32)
+    resumed = load_checkpoint(checkpointPath, config, num_blocks, num_rows)
+    if resumed is not None:
+        done_blocks, exceedances, n_drawn, perm_max, perm_min = resumed
+        print(f"Resuming from checkpoint: {int(done_blocks.sum())} of {num_blocks} permutation blocks already done")
+        if nullDumpPath is not None and not os.path.exists(nullDumpPath):
+            raise RuntimeError(f"Cannot resume the null dump: {nullDumpPath} is missing")
+        if supra_critical is not None and not all(os.path.exists(os.path.join(supraDir, f'block_{b}.npy'))
+                                                  for b in np.flatnonzero(done_blocks)):
+            raise RuntimeError(f"Cannot resume the supra-threshold sets: block parts are missing from {supraDir}")
+    if supra_critical is not None and resumed is None:
+        shutil.rmtree(supraDir, ignore_errors=True)
+    if supra_critical is not None:
+        os.makedirs(supraDir, exist_ok=True)
+
+    if nullDumpPath is not None and resumed is None:
+        # Debug only: keeps the full rows x nPermutations null on disk.
+        mmap_file = np.lib.format.open_memmap(
+            nullDumpPath,
+            mode='w+',
+            dtype=np.float32,
+            shape=(num_rows, nPermutations)
+        )
+        del mmap_file
+
+    active_rows = np.arange(num_rows)
+    published_rows = active_rows
+    view = (rx_path, observed_path, None, segments_path)
+    pending = [b for b in range(num_blocks) if not done_blocks[b]]
+    settings = {
+        'alternative': alternative,
+        'null_path': nullDumpPath,
+        'row_chunk': rowChunk,
+        'seed': seed,
+        'stream_key': streamKey,
+        'exact': exact,
+        'statistic': whichCorrelation,
+        'n_segments': n_segments,
+        'segment_starts': segment_starts,
+        'supra_dir': supraDir if supra_critical is not None else None,
+        'supra_critical': supra_critical,
+        'supra_rows': int(segment_starts[1]),
+    }
+    with worker_blas_environment(1):
+        pool = multiprocessing.Pool(n_cores, initializer=init_worker, initargs=(effect_items, settings))
+    with pool:
+        for i in range(0, len(pending), blocks_per_batch):
+            if adaptive:
+                still_active = exceedances[active_rows] < adaptiveExceedances
+                if not still_active.all():
+                    active_rows = active_rows[still_active]
+                    if active_rows.shape[0] == 0:
+                        print('Every vertex reached the stopping rule')
+                        break
+                    published_rows, view = publish_view(shared_dir, i, view, observed, row_segments, published_rows,
+                                                        active_rows, compactFraction, rowChunk)
+                    print(f'{active_rows.shape[0]} of {num_rows} vertices still active')
+            tasks = [(b, b * blockSize, min(blockSize, nPermutations - b * blockSize), view, 0) for b in pending[i:i + blocks_per_batch]]
+            for block_index, counts, block_max, block_min, _ in pool.imap_unordered(worker, tasks):
+                exceedances[active_rows] += counts
+                block_start = block_index * blockSize
+                n_drawn[active_rows] += block_max.shape[1]
+                perm_max[:, block_start:block_start + block_max.shape[1]] = block_max
+                perm_min[:, block_start:block_start + block_min.shape[1]] = block_min
+                done_blocks[block_index] = True
+            if checkpointPath is not None:
+                save_checkpoint(checkpointPath, config, done_blocks, exceedances, n_drawn, perm_max, perm_min)
+            print(f'{int(done_blocks.sum())} of {num_blocks} permutation blocks completed')
+
+        # Tail pass: the seeded blocks are replayed for the few vertices whose empirical p-value
+        # rests on fewer than tailMinExceedances exceedances, streaming the top values of their null.
+        tail_rows = None
+        if tailFitSize > 0 and not exact and done_blocks.all():
+            tail_rows = np.flatnonzero((n_drawn == nPermutations) & (exceedances < tailMinExceedances) & np.isfinite(observed))
+            print(f'Fitting the null tail for {tail_rows.shape[0]} vertices')
+        if tail_rows is not None and tail_rows.shape[0] > 0:
+            _, tail_view = publish_view(shared_dir, 'tail', (rx_path, observed_path, None, segments_path), observed,
+                                        row_segments, np.arange(num_rows), tail_rows, 1.0, rowChunk)
+            tail_top = np.full((tail_rows.shape[0], tailFitSize + 1), -np.inf, dtype=np.float32)
+            tasks = [(b, b * blockSize, min(blockSize, nPermutations - b * blockSize), tail_view, tailFitSize + 1)
+                     for b in range(num_blocks)]
+            for _, _, _, _, top in pool.imap_unordered(worker, tasks):
+                tail_top = top_values(np.concatenate([tail_top, top], axis=1), tailFitSize + 1)
+        pool.close()
+        pool.join()
+    # All distinct patterns carry the same weight, so in exact mode the plain pattern count is the exact p-value.
+    # Stopped vertices get exceedances / permutations drawn, the Besag-Clifford estimate.
+    p_values = (exceedances / np.maximum(n_drawn, 1)).astype(np.float32)
+    tail_shape = tail_scale = tail_ad = None
+    if tail_rows is not None:
+        tail_shape = np.full(num_rows, np.nan, dtype=np.float32)
+        tail_scale = np.full(num_rows, np.nan, dtype=np.float32)
+        tail_ad = np.full(num_rows, np.nan, dtype=np.float32)
+        if tail_rows.shape[0] > 0:
+            tail_p, shape, scale, ad, valid = gpd_tail_pvalues(orient_statistic(observed[tail_rows], alternative), tail_top, nPermutations)
+            fitted = tail_rows[valid]
+            p_values[fitted] = tail_p[valid]
+            tail_shape[fitted] = shape[valid]
+            tail_scale[fitted] = scale[valid]
+            tail_ad[fitted] = ad[valid]
+    supra_key = None
+    if supra_critical is not None:
+        supra_key = permutation_key(effect_items, nPermutations, blockSize, seed, streamKey, exact)
+    results = []
+    for segment in range(n_segments):
+        rows = slice(segment_starts[segment], segment_starts[segment + 1])
+        supra = None
+        if supra_critical is not None and segment == 0:
+            supra = {
+                'threshold': supraThreshold,
+                'critical': supra_critical,
+                'masks_path': assemble_supra_masks(supraDir, segment_rows[0], num_blocks, blockSize, nPermutations),
+                'observed': np.flatnonzero(orient_statistic(observed[rows], alternative) > supra_critical).astype(np.int32),
+                'permutation_key': supra_key,
+            }
+        if adaptive:
+            # The maxima only cover the vertices still active, so they are no max-statistic null.
+            p_fwer = None
+        else:
+            p_fwer = maxstat_pvalues(observed[rows], perm_max[segment], perm_min[segment], alternative)
+        results.append({
+            'exact': exact,
+            'adaptive': adaptive,
+            'n_permutations': nPermutations,
+            'n_drawn': n_drawn[rows],
+            'observed': observed[rows],
+            'p_values': p_values[rows],
+            'p_fwer': p_fwer,
+            'perm_max': perm_max[segment],
+            'perm_min': perm_min[segment],
+            'tail_shape': tail_shape[rows] if tail_shape is not None else None,
+            'tail_scale': tail_scale[rows] if tail_scale is not None else None,
+            'tail_ad': tail_ad[rows] if tail_ad is not None else None,
+            'supra': supra,
+        })
+    return results
+
+def save_supra_sets(supra, savePath, masksPath, whichCorrelation, alternative, num_rows, exact):
+    # The masks are moved next to the other statistics as a plain .npy, so readers can memory-map them.
+    os.replace(supra['masks_path'], masksPath)
+    np.savez(savePath, observed=supra['observed'], threshold=supra['threshold'],
+             critical=supra['critical'], permutation_key=supra['permutation_key'], statistic=whichCorrelation,
+             alternative=alternative, n_rows=num_rows, exact=exact)
+
+def mesh_geometry_hash(path, chunkSize=1 << 20):
+    # Hash of a .msh file up to the end of its $Elements section: header, nodes and elements, without the
+    # fields written after them, so every mesh solved on the same head mesh gets the same key.
+    marker = b'$EndElements'
+    h = hashlib.sha1()
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        end = buf.find(marker)
+        end = len(buf) if end < 0 else end + len(marker)
+        for start in range(0, end, chunkSize):
+            h.update(buf[start:min(start + chunkSize, end)])
+    return h.hexdigest()
+
+def temporary_path(directory, suffix):
+    # A name unique to this call: runs of several types may build the same cache entry concurrently.
+    fd, path = tempfile.mkstemp(dir=directory, suffix=suffix)
+    os.close(fd)
+    return path
+
+# Cropped grey matter and element-to-node operator per mesh geometry, shared by every type of a run.
+_gray_matter_cache = {}
+
+def load_gray_matter(meshPath, cacheDir):
+    # The cropped grey matter and its sparse elm2node operator depend only on the subject geometry, so they
+    # are built once per geometry and kept on disk next to the subject for later runs.
+    from simnibs import read_msh
+
+    key = mesh_geometry_hash(meshPath)
+    if key in _gray_matter_cache:
+        return _gray_matter_cache[key]
+    gm_path = os.path.join(cacheDir, f'gray_matter_{key}.msh')
+    op_path = os.path.join(cacheDir, f'elm2node_{key}.npz')
+    if os.path.exists(gm_path) and os.path.exists(op_path):
+        gray_matter = read_msh(gm_path)
+        elm2node = scipy.sparse.load_npz(op_path).tocsr()
+    else:
+        os.makedirs(cacheDir, exist_ok=True)
+        gray_matter = read_msh(meshPath).crop_mesh(2)
+        # Only the geometry is cached; the fields of the study the mesh came from are dropped.
+        gray_matter.nodedata = []
+        gray_matter.elmdata = []
+        elm2node = scipy.sparse.csr_matrix(gray_matter.elm2node_matrix())
+        tmp_gm_path = temporary_path(cacheDir, '.tmp.msh')
+        tmp_op_path = temporary_path(cacheDir, '.tmp.npz')
+        gray_matter.write(tmp_gm_path)
+        scipy.sparse.save_npz(tmp_op_path, elm2node)
+        os.replace(tmp_op_path, op_path)
+        os.replace(tmp_gm_path, gm_path)
+    _gray_matter_cache[key] = (gray_matter, elm2node)
+    return _gray_matter_cache[key]
+
+def find_geometry_mesh(subpath, subject_name, type_paths):
+    # Every full solve of the subject is on the same head mesh, so the first study mesh found gives the grey
+    # matter geometry for all types. Lead-field studies have no mesh; when all studies are lead-field, the
+    # m2m head mesh the lead fields were evaluated on is used.
+    for type_path in type_paths:
+        if not os.path.isdir(type_path):
+            continue
+        for study in sorted(os.listdir(type_path)):
+            mesh_path = os.path.join(type_path, study, f'{subject_name}_TDCS_1_scalar.msh')
+            if os.path.exists(mesh_path):
+                return mesh_path
+    head_mesh = os.path.join(subpath, f'{subject_name}.msh')
+    return head_mesh if os.path.exists(head_mesh) else None
+
+def computeMesh(gray_matter, fields, writePath, variant):
+    from simnibs import NodeData
 
-def computeMesh(mesh_head, fields, writePath, variant):
     if variant == "base":
-        gray_matter = mesh_head.crop_mesh(2)  
-        for field_name, field_values in fields.items():
-            field_flipped = field_values * 1
-            M = gray_matter.elm2node_matrix()
-            field_nodal = M.dot(field_flipped)
-            field_data = simnibs.NodeData(field_nodal, name=field_name)
-            gray_matter.add_node_field(field_data, '-' + field_name)
-        gray_matter.write(writePath)
+        mesh, elm2node = gray_matter
+        field_names = list(fields)
+        # All fields are projected onto the nodes in one sparse-dense product.
+        field_nodal = elm2node.dot(np.column_stack([fields[name] for name in field_names]))
+        mesh.nodedata = []
+        for column, field_name in enumerate(field_names):
+            field_data = NodeData(field_nodal[:, column], name=field_name)
+            mesh.add_node_field(field_data, '-' + field_name)
+        mesh.write(writePath)
     else:
         np.save(writePath, fields)
 
-if __name__ == "__main__":
+def main(argv=None):
     import argparse
     parser = argparse.ArgumentParser(description="Combined processing for correlation, percentiles, and mesh generation")
     parser.add_argument("subpath", help="Path to the subject's mesh directory.")
     parser.add_argument("data_filepath", help="Path to the CSV file.")
-    args = parser.parse_args()
+    parser.add_argument("--cores", type=int, default=os.cpu_count(),
+                        help="Permutation workers; each runs single-threaded BLAS.")
+    parser.add_argument("--types", nargs='+', default=['ToM', 'Altruism', 'Empathy'],
+                        help="Attribute types to correlate.")
+    parser.add_argument("--steps", nargs='+', choices=['statistics', 'mesh'], default=['statistics', 'mesh'],
+                        help="statistics writes the correlations folder, mesh the result meshes from it.")
+    parser.add_argument("--result-dir",
+                        help="Folder receiving allMeshes/ResultMesh (default: the subject folder in the OneDrive copy).")
+    args = parser.parse_args(argv)
 
     logging.basicConfig(filename='error_log.log',
                         level=logging.DEBUG,
@@ -157,25 +938,49 @@ if __name__ == "__main__":
 
     subject_basename = os.path.basename(os.path.normpath(args.subpath))
     subject_name = subject_basename.split('m2m_')[-1]
-    new_save_base = os.path.join(r"C:\Users\Gabma\OneDrive\Dokumente\tDCS_PEC_Python\HeadMeshes", subject_basename)
+    new_save_base = args.result_dir or os.path.join(r"C:\Users\Gabma\OneDrive\Dokumente\tDCS_PEC_Python\HeadMeshes", subject_basename)
 
     df = pd.read_csv(args.data_filepath)
     expName = df['Name'].to_numpy()
     effectSize = df['fixedG'].to_numpy(dtype=np.float32)
     attributeType = df['Type'].to_numpy()
     data = pd.DataFrame({'Name': expName, 'fixedG': effectSize, 'Type': attributeType})
-    result = data.groupby('Name').agg({'fixedG': 'mean', 'Type': 'first'}).reset_index()
+
+    whichCorrelation = 'SpearmanRow'  # SpearmanRow, PearsonRow, KendallRow, WeightedSpearmanRow, WeightedPearsonRow
+    useWeights = get_statistic(whichCorrelation)['weighted']
+    aggregations = {'fixedG': 'mean', 'Type': 'first'}
+    if useWeights:
+        # Variance of the mean of a study's rows, assuming they are independent.
+        data['Variance'] = effect_size_variance(df).to_numpy()
+        aggregations['Variance'] = lambda v: v.sum() / len(v) ** 2
+    result = data.groupby('Name').agg(aggregations).reset_index()
     expName = result['Name'].to_numpy()
     effectSize = result['fixedG'].to_numpy(dtype=np.float32)
     attributeType = result['Type'].to_numpy()
+    studyWeights = 1.0 / result['Variance'].to_numpy(dtype=np.float64) if useWeights else None
 
-    whichCorrelation = 'SpearmanRow'
-    listAttributeTypes = ['ToM', 'Altruism', 'Empathy']
+    listAttributeTypes = args.types
     doPermutations = 1
     nPermutations = 5000
     permBatchSize = 1024
-    nCores = 20
-    percentileBatchSize = 100000
+    nCores = args.cores
+    alternative = 'greater'
+    saveNullDistribution = 0  # debug: also dump the full null to randCorr*.npy
+    permSeed = 20240917
+    permBlockSize = 64
+    exactLimit = 100000  # enumerate every distinct rank pattern when there are at most this many
+    adaptiveExceedances = 0  # > 0: stop permuting a vertex once it has this many exceedances (no FWER map)
+    tailFitSize = 0  # > 0: GPD fit on this many top null values where fewer than tailMinExceedances are exceeded
+    tailMinExceedances = 10
+    jointVariants = 1  # permute all variants of a type together in one pass over the same permutations
+    rowChunk = 65536  # rows resident at once; bounds memory independently of the mesh resolution
+    # > 0: keep every permutation's base-variant vertices with analytic -log10(p) above supraThreshold for
+    # do_combinedP.py --spatial-null, as bit masks of rows / 8 bytes per permutation (625 MB per type for
+    # 1M rows and 5000 permutations); skipped for the weighted statistics, which have no analytic p-value.
+    supraThreshold = 1.2
+
+    grayMatterCacheDir = os.path.join(args.subpath, 'gray_matter_cache')
+    gray_matter = None
 
     for currType in listAttributeTypes:
         print("Processing attribute:", currType)
@@ -183,63 +988,151 @@ if __name__ == "__main__":
         os.makedirs(saveToPath, exist_ok=True)
 
         type_path = os.path.join(base_path, currType)
-        # for variant in ['fsavg_overlays', 'base', 'subject_overlays']:
-        # for variant in ['fsavg_overlays', 'subject_overlays']:
-        for variant in ['base']:
-            print("Processing variant:", variant)
+        attr_loc = (attributeType == currType)
+        currEffectSize = effectSize[attr_loc]
+        currWeights = studyWeights[attr_loc] if useWeights else None
+
+        meshes = {}
+        matrices = {}
+        for variant in ['base', 'fsavg_overlays', 'subject_overlays']:
+            matrice_totale_path = os.path.join(base_path, currType, f'{currType}_matrice_totale_{variant}.npy')
+            columns_path = matrice_totale_path[:-len('.npy')] + '_columns.csv'
+            if variant != 'base' and not (os.path.exists(matrice_totale_path) and os.path.exists(columns_path)):
+                # Overlays are optional: meshToNpy_step2.py writes them only when the studies have them.
+                continue
             if variant == "base":
-                subdirs = [d for d in os.listdir(type_path) if os.path.isdir(os.path.join(type_path, d))]
-                if not subdirs:
-                    print("No subdirectories found in", type_path)
-                    continue
-                first_subdir = subdirs[0]
-                currMeshHead = os.path.join(type_path, first_subdir, f'{subject_name}_TDCS_1_scalar.msh')
-                if not os.path.exists(currMeshHead):
-                    print("Mesh file not found:", currMeshHead)
-                    continue
-                mesh_head = simnibs.read_msh(currMeshHead)
+                # The geometry is only needed to write the result meshes.
+                if 'mesh' in args.steps and gray_matter is None:
+                    currMeshHead = find_geometry_mesh(args.subpath, subject_name,
+                                                      [type_path] + [os.path.join(base_path, t) for t in listAttributeTypes])
+                    if currMeshHead is None:
+                        print("No study mesh or head mesh found for", args.subpath)
+                        continue
+                    gray_matter = load_gray_matter(currMeshHead, grayMatterCacheDir)
+                meshes[variant] = gray_matter
             else:
-                mesh_head = 0
+                meshes[variant] = 0
 
-            matrice_totale_path = os.path.join(base_path, currType, f'{currType}_matrice_totale_{variant}.npy')
-            currMatrix = np.load(matrice_totale_path).astype(np.float32)
-            attr_loc = (attributeType == currType)
-            currEffectSize = effectSize[attr_loc]
-
-            start_time = time.time()
-            allCoeffs, _ = runCorrelation(currMatrix, currEffectSize, whichCorrelation)
-            elapsed_time = time.time() - start_time
-            print("Correlation time:", elapsed_time)
-            corr_save_path = os.path.join(saveToPath, f'corr{whichCorrelation}_{variant}.npy')
-            np.save(corr_save_path, allCoeffs)
+            if os.path.exists(columns_path):
+                # Written by meshToNpy_step2.py; the columns must be the studies of the effect-size vector, in order.
+                column_names = pd.read_csv(columns_path, dtype=str, keep_default_na=False)['Name'].to_numpy()
+                if not np.array_equal(column_names, expName[attr_loc].astype(str)):
+                    if variant != 'base':
+                        print(f"Skipping {variant}: the columns of {matrice_totale_path} do not match the "
+                              f"{currType} studies")
+                        continue
+                    raise ValueError(f"The columns of {matrice_totale_path} do not match the {currType} studies in "
+                                     f"{args.data_filepath}; rerun simFromCSV_step1.py and meshToNpy_step2.py with --update")
+            # Memory-mapped: ranking, correlation, permutations and the average field all stream row blocks.
+            matrices[variant] = np.load(matrice_totale_path, mmap_mode='r')
 
-            if doPermutations == 1:
-                randCorr_path = os.path.join(saveToPath, f'randCorr{whichCorrelation}_{variant}.npy')
-                parallel_process(currMatrix, currEffectSize, whichCorrelation, nPermutations, permBatchSize, randCorr_path, nCores)
+        joint_results = None
+        joint_checkpoint_path = None
+        if 'statistics' in args.steps and doPermutations == 1 and jointVariants == 1 and len(matrices) > 1:
+            # One pass over all variants: the same permutations, ranking and worker pool for every variant,
+            # so their nulls are directly comparable.
+            randCorr_path = None
+            if saveNullDistribution == 1:
+                randCorr_path = os.path.join(saveToPath, f'randCorr{whichCorrelation}_joint.npy')
+            joint_checkpoint_path = os.path.join(saveToPath, f'permCheckpoint{whichCorrelation}_joint.npz')
+            joint_supra_dir = os.path.join(saveToPath, f'permSupra{whichCorrelation}_joint')
+            joint_results = dict(zip(matrices, parallel_process(
+                list(matrices.values()), currEffectSize, whichCorrelation, nPermutations, permBatchSize, nCores, saveToPath,
+                alternative=alternative, nullDumpPath=randCorr_path, blockSize=permBlockSize,
+                seed=permSeed, streamKey=stream_key_for(currType), checkpointPath=joint_checkpoint_path,
+                exactLimit=exactLimit, adaptiveExceedances=adaptiveExceedances,
+                tailFitSize=tailFitSize, tailMinExceedances=tailMinExceedances, rowChunk=rowChunk,
+                weights=currWeights, supraThreshold=supraThreshold if 'base' in matrices else 0, supraDir=joint_supra_dir)))
 
-                original_values = np.load(corr_save_path)
-                p_values = read_mmap_file_and_compute_pvalues(randCorr_path, original_values, percentileBatchSize)
-                neg_log10_p_values = -np.log10(np.clip(p_values, 1e-10, None))
-                negLog_save_path = os.path.join(saveToPath, f'{currType}_{variant}_negLog10Pvalues.npy')
+        for variant, currMatrix in matrices.items():
+            print("Processing variant:", variant)
+            corr_save_path = os.path.join(saveToPath, f'corr{whichCorrelation}_{variant}.npy')
+            negLog_save_path = os.path.join(saveToPath, f'{currType}_{variant}_negLog10Pvalues.npy')
+            negLogFWER_save_path = os.path.join(saveToPath, f'{currType}_{variant}_negLog10PvaluesFWER.npy')
+            extremes_save_path = os.path.join(saveToPath, f'{currType}_{variant}_permExtremes.npz')
+            tail_save_path = os.path.join(saveToPath, f'{currType}_{variant}_tailFit.npz')
+            supra_save_path = os.path.join(saveToPath, f'{currType}_{variant}_permSupra.npz')
+            supra_masks_path = os.path.join(saveToPath, f'{currType}_{variant}_permSupraMasks.npy')
+            if 'statistics' in args.steps:
+                # Outputs this configuration does not produce are removed, so the folder always holds
+                # the statistics of the last run and the mesh step can take whatever it finds.
+                for stale_path in (negLog_save_path, negLogFWER_save_path, extremes_save_path, tail_save_path,
+                                   supra_save_path, supra_masks_path):
+                    if os.path.exists(stale_path):
+                        os.remove(stale_path)
+            if 'statistics' in args.steps and doPermutations == 0:
+                start_time = time.time()
+                allCoeffs, allNegLogP = runCorrelation(currMatrix, currEffectSize, whichCorrelation, weights=currWeights,
+                                                       alternative=alternative, rowChunk=rowChunk)
+                elapsed_time = time.time() - start_time
+                print("Correlation time:", elapsed_time)
+                np.save(corr_save_path, allCoeffs)
+                if allNegLogP is not None:
+                    np.save(negLog_save_path, allNegLogP)
+
+            if 'statistics' in args.steps and doPermutations == 1:
+                checkpoint_path = None
+                supra_dir = None
+                if joint_results is not None:
+                    perm_result = joint_results[variant]
+                else:
+                    randCorr_path = None
+                    if saveNullDistribution == 1:
+                        randCorr_path = os.path.join(saveToPath, f'randCorr{whichCorrelation}_{variant}.npy')
+                    checkpoint_path = os.path.join(saveToPath, f'permCheckpoint{whichCorrelation}_{variant}.npz')
+                    supra_dir = os.path.join(saveToPath, f'permSupra{whichCorrelation}_{variant}')
+                    perm_result = parallel_process(currMatrix, currEffectSize, whichCorrelation, nPermutations, permBatchSize, nCores, saveToPath,
+                                                   alternative=alternative, nullDumpPath=randCorr_path, blockSize=permBlockSize,
+                                                   seed=permSeed, streamKey=stream_key_for(currType), checkpointPath=checkpoint_path,
+                                                   exactLimit=exactLimit, adaptiveExceedances=adaptiveExceedances,
+                                                   tailFitSize=tailFitSize, tailMinExceedances=tailMinExceedances, rowChunk=rowChunk,
+                                                   weights=currWeights, supraThreshold=supraThreshold if variant == 'base' else 0,
+                                                   supraDir=supra_dir)
+                np.save(corr_save_path, perm_result['observed'])
+                neg_log10_p_values = -np.log10(np.clip(perm_result['p_values'], 1e-10, None))
                 np.save(negLog_save_path, neg_log10_p_values)
-            else:
-                negLog_save_path = None
+                if perm_result['p_fwer'] is not None:
+                    neg_log10_p_fwer = -np.log10(np.clip(perm_result['p_fwer'], 1e-10, None))
+                    np.save(negLogFWER_save_path, neg_log10_p_fwer)
+                    np.savez(extremes_save_path, perm_max=perm_result['perm_max'], perm_min=perm_result['perm_min'])
+                if perm_result['tail_shape'] is not None:
+                    np.savez(tail_save_path, tailShape=perm_result['tail_shape'], tailScale=perm_result['tail_scale'],
+                             tailAD=perm_result['tail_ad'])
+                if perm_result['supra'] is not None:
+                    save_supra_sets(perm_result['supra'], supra_save_path, supra_masks_path, whichCorrelation,
+                                    alternative, perm_result['observed'].shape[0], perm_result['exact'])
+                if checkpoint_path is not None:
+                    os.remove(checkpoint_path)
+                if supra_dir is not None:
+                    shutil.rmtree(supra_dir, ignore_errors=True)
 
+            if 'mesh' not in args.steps:
+                print("Completed variant:", variant)
+                continue
             pec = np.load(corr_save_path)
-            if negLog_save_path:
-                neg_log10_p_values = np.load(negLog_save_path)
-            else:
-                neg_log10_p_values = None
-            average_Mesh = np.mean(currMatrix, axis=1)
-            fields = {'PEC': pec, 'negLog10Pvalues': neg_log10_p_values, 'averageMesh': average_Mesh}
+            fields = {'PEC': pec}
+            if os.path.exists(negLog_save_path):
+                fields['negLog10Pvalues'] = np.load(negLog_save_path)
+            if os.path.exists(negLogFWER_save_path):
+                fields['negLog10PvaluesFWER'] = np.load(negLogFWER_save_path)
+            if os.path.exists(tail_save_path):
+                with np.load(tail_save_path) as tail_fit:
+                    fields.update({name: tail_fit[name] for name in tail_fit.files})
+            average_Mesh = row_means(currMatrix, rowChunk)
+            fields['averageMesh'] = average_Mesh
             result_mesh_dir = os.path.join(new_save_base, 'allMeshes', 'ResultMesh', currType)
             os.makedirs(result_mesh_dir, exist_ok=True)
             writePath = os.path.join(result_mesh_dir, f'{currType}_{variant}_result_mesh.msh')
-            computeMesh(mesh_head, fields, writePath, variant)
-            if doPermutations == 1 and os.path.exists(randCorr_path):
-                os.remove(randCorr_path)
+            computeMesh(meshes[variant], fields, writePath, variant)
             print("Completed variant:", variant)
 
+        if joint_checkpoint_path is not None:
+            os.remove(joint_checkpoint_path)
+            shutil.rmtree(joint_supra_dir, ignore_errors=True)
+
         print("Completed attribute:", currType)
 
     print("Processing completed.")
+
+if __name__ == "__main__":
+    main()
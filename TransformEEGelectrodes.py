@@ -34,12 +34,12 @@ def apply_transformation(file_path, transformation_matrix, output_file):
     full_data.to_csv(output_file, index=False, header=False)
     print(f"Transformed coordinates saved to {output_file}")
 
-if __name__ == "__main__":
+def main(argv=None):
     import argparse
     parser = argparse.ArgumentParser(description="Run SimNIBS simulations from CSV input.")
     parser.add_argument("subpath", help="Path to the subject's mesh directory.")
     parser.add_argument("erniePath", help="Path to the Ernie folder.")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     source_file = os.path.join(args.erniePath,'EEG10-10_UI_Jurak_2007.csv')
     target_file = os.path.join(args.subpath, "EEG10-10_UI_Jurak_2007.csv")
     file_to_transform = os.path.join(args.erniePath, "EEG10-20_extended_SPM12.csv")
@@ -50,3 +50,6 @@ if __name__ == "__main__":
     print("Transformation Matrix (4x4):")
     print(transformation_matrix)
     apply_transformation(file_to_transform, transformation_matrix, output_file)
+
+if __name__ == "__main__":
+    main()
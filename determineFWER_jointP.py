@@ -1,4 +1,6 @@
 import numpy as np
+import pandas as pd
+import scipy.stats
 from tqdm import tqdm
 from joblib import Parallel, delayed
 import os
@@ -8,55 +10,132 @@ THRESHOLD = 1.0
 N_SAMPLES_PER_RUN = 1_000_000
 N_PERMUTATIONS = 5000
 N_CORES = 20
-def run_single_permutation(n_samples, n_subjects, threshold):
-    random_p_values = np.random.uniform(0.0, 1.0, size=(n_samples, n_subjects))
+SEED = 20240917
+
+def conjunction_probability(n_subjects, threshold, k=None):
+    # Probability that one test is a conjunction hit: at least k of n independent subjects with
+    # -log10(p) > threshold, each with probability 10^-threshold under the null.
+    k = n_subjects if k is None else k
+    return scipy.stats.binom.sf(k - 1, n_subjects, 10.0 ** -np.asarray(threshold, dtype=np.float64))
+
+def analytical_fwer(n_subjects, threshold, n_samples, k=None):
+    # P(at least one hit among n_samples independent tests) = 1 - (1 - q)^n_samples, without cancellation.
+    q = conjunction_probability(n_subjects, threshold, k)
+    return -np.expm1(n_samples * np.log1p(-q))
+
+def sampled_fwer(n_subjects, threshold, n_samples, n_permutations, k=None, seed=SEED):
+    # The number of hits of one simulation is Binomial(n_samples, q): draw it directly instead of the
+    # n_samples x n_subjects uniforms it summarises.
+    q = conjunction_probability(n_subjects, threshold, k)
+    hits = np.random.default_rng(seed).binomial(n_samples, q, size=n_permutations)
+    return np.mean(hits > 0)
+
+def fwer_table(thresholds, subject_counts, ks, sample_counts, n_permutations=0, seed=SEED):
+    """Closed-form FWER for every combination, plus a binomial-sampling estimate when n_permutations > 0.
+    ks of None stand for all subjects; combinations with k above the subject count are skipped."""
+    rows = []
+    for n_subjects in subject_counts:
+        for k in ks:
+            k = n_subjects if k is None else k
+            if k > n_subjects:
+                continue
+            for threshold in thresholds:
+                q = conjunction_probability(n_subjects, threshold, k)
+                for n_samples in sample_counts:
+                    row = {'Subjects': n_subjects, 'K': k, 'Threshold': threshold, 'Tests': n_samples,
+                           'PerTestProbability': q, 'ExpectedHits': n_samples * q,
+                           'FWER': analytical_fwer(n_subjects, threshold, n_samples, k)}
+                    if n_permutations > 0:
+                        row['SampledFWER'] = sampled_fwer(n_subjects, threshold, n_samples, n_permutations, k,
+                                                          seed=[seed, n_subjects, k, len(rows)])
+                    rows.append(row)
+    return pd.DataFrame(rows)
+
+def run_single_permutation(n_samples, n_subjects, threshold, k=None, seed=None):
+    k = n_subjects if k is None else k
+    random_p_values = np.random.default_rng(seed).uniform(0.0, 1.0, size=(n_samples, n_subjects))
     random_neg_log_p = -np.log10(random_p_values)
     is_significant = random_neg_log_p > threshold
-    conjunction_found = np.all(is_significant, axis=1)
+    conjunction_found = np.sum(is_significant, axis=1) >= k
     if np.any(conjunction_found):
         return 1
     return 0
 
-def run_parallel_fwer_simulation(n_subjects, threshold, n_samples, n_permutations, n_cores):
+def run_parallel_fwer_simulation(n_subjects, threshold, n_samples, n_permutations, n_cores, k=None, seed=SEED, verbose=True):
 
-    print("--- Starting PARALLEL FWER Calculation using Monte Carlo Sampling ---")
-    print(f"Parameters:")
-    print(f"  - Number of subjects: {n_subjects}")
-    print(f"  - Significance threshold: -log10(p) > {threshold} (p < {10**-threshold:.2f})")
-    print(f"  - Independent tests per simulation: {n_samples:,}")
-    print(f"  - Total simulations (permutations): {n_permutations:,}")
-    print(f"  - CPU Cores to be used: {n_cores}")
-    print("-" * 60)
-    tasks = (delayed(run_single_permutation)(n_samples, n_subjects, threshold) for _ in range(n_permutations))
+    if verbose:
+        print("--- Starting PARALLEL FWER Calculation using Monte Carlo Sampling ---")
+        print(f"Parameters:")
+        print(f"  - Number of subjects: {n_subjects}")
+        print(f"  - Significance threshold: -log10(p) > {threshold} (p < {10**-threshold:.2f})")
+        print(f"  - Independent tests per simulation: {n_samples:,}")
+        print(f"  - Total simulations (permutations): {n_permutations:,}")
+        print(f"  - CPU Cores to be used: {n_cores}")
+        print("-" * 60)
+    # One independent stream per simulation, so the result does not depend on the number of cores.
+    seeds = np.random.SeedSequence(seed).spawn(n_permutations)
+    tasks = (delayed(run_single_permutation)(n_samples, n_subjects, threshold, k, seeds[i]) for i in range(n_permutations))
 
     with Parallel(n_jobs=n_cores) as parallel:
-        results = parallel(tqdm(tasks, total=n_permutations, desc="Running Simulations"))
+        results = parallel(tqdm(tasks, total=n_permutations, desc="Running Simulations", disable=not verbose))
     permutations_with_positives = sum(results)
     fwer = permutations_with_positives / n_permutations
-    
+
     return fwer
 
+def cross_check(thresholds, subject_counts, ks, sample_counts, n_permutations, n_cores, seed=SEED):
+    # Brute-force simulation against the closed form, for sizes small enough to simulate. Z is the
+    # difference in binomial standard errors of the closed-form FWER.
+    table = fwer_table(thresholds, subject_counts, ks, sample_counts)
+    brute = []
+    for row in table.itertuples():
+        brute.append(run_parallel_fwer_simulation(row.Subjects, row.Threshold, row.Tests, n_permutations, n_cores,
+                                                  k=row.K, seed=[seed, row.Index], verbose=False))
+    table['BruteForceFWER'] = brute
+    standard_error = np.sqrt(table['FWER'] * (1 - table['FWER']) / n_permutations)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table['Z'] = np.where(standard_error > 0, (table['BruteForceFWER'] - table['FWER']) / standard_error,
+                              np.where(table['BruteForceFWER'] == table['FWER'], 0.0, np.inf))
+    table['Consistent'] = np.abs(table['Z']) < 4
+    return table
+
 
 if __name__ == "__main__":
-    fwer_empirical = run_parallel_fwer_simulation(
-        n_subjects=N_SUBJECTS,
-        threshold=THRESHOLD,
-        n_samples=N_SAMPLES_PER_RUN,
-        n_permutations=N_PERMUTATIONS,
-        n_cores=N_CORES
-    )
-
-    print(f"This result applies to both 'ToM' and 'Empathy' analyses.") 
-    if fwer_empirical == 0:
-        print(f"No false positives found in {N_PERMUTATIONS:,} simulations of {N_SAMPLES_PER_RUN:,} tests each.")
-        print(f"The joint probability of a false positive is p < {1/N_PERMUTATIONS:.5f}")
+    import argparse
+    parser = argparse.ArgumentParser(description="FWER of the cross-subject conjunction over independent tests.")
+    parser.add_argument("--thresholds", nargs='+', type=float, default=[THRESHOLD], help="-log10(p) thresholds.")
+    parser.add_argument("--subjects", nargs='+', type=int, default=[N_SUBJECTS], help="Numbers of subjects.")
+    parser.add_argument("--k", nargs='+', type=int,
+                        help="Minimum numbers of significant subjects (default: all subjects).")
+    parser.add_argument("--tests", nargs='+', type=int, default=[N_SAMPLES_PER_RUN],
+                        help="Numbers of independent tests (vertices).")
+    parser.add_argument("--permutations", type=int, default=N_PERMUTATIONS,
+                        help="Simulations of the binomial-sampling estimate; 0 for the closed form only.")
+    parser.add_argument("--output", help="CSV file receiving the table.")
+    parser.add_argument("--cross-check", action="store_true",
+                        help="Compare the closed form with brute-force simulation of the uniform p-values; "
+                             "use small --tests and --subjects.")
+    parser.add_argument("--cores", type=int, default=N_CORES, help="Cores of the brute-force simulation.")
+    args = parser.parse_args()
+    ks = args.k or [None]
+
+    if args.cross_check:
+        table = cross_check(args.thresholds, args.subjects, ks, args.tests, args.permutations, args.cores)
     else:
-        print(f"The empirically calculated joint probability (FWER) is p = {fwer_empirical:.5f}")
-
-    p_individual_chance = 10**-THRESHOLD
-    p_joint_chance = p_individual_chance ** N_SUBJECTS
-    p_no_conjunction_one_test = 1 - p_joint_chance
-    p_no_conjunction_all_tests = (p_no_conjunction_one_test) ** N_SAMPLES_PER_RUN
-    fwer_analytical = 1 - p_no_conjunction_all_tests
-    
-    print(f"The theoretical FWER for {N_SAMPLES_PER_RUN:,} independent tests is p = {fwer_analytical:.5f}")
+        table = fwer_table(args.thresholds, args.subjects, ks, args.tests, args.permutations)
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(table.to_string(index=False))
+    if args.output:
+        table.to_csv(args.output, index=False)
+
+    if len(table) == 1 and 'SampledFWER' in table:
+        fwer_empirical = table['SampledFWER'].iloc[0]
+        print(f"This result applies to both 'ToM' and 'Empathy' analyses.")
+        if fwer_empirical == 0:
+            print(f"No false positives found in {args.permutations:,} simulations of {args.tests[0]:,} tests each.")
+            print(f"The joint probability of a false positive is p < {1/args.permutations:.5f}")
+        else:
+            print(f"The empirically calculated joint probability (FWER) is p = {fwer_empirical:.5f}")
+        print(f"The theoretical FWER for {args.tests[0]:,} independent tests is p = {table['FWER'].iloc[0]:.5f}")
+    if args.cross_check and not table['Consistent'].all():
+        print("Brute-force simulation disagrees with the closed form for the rows with |Z| >= 4.")
@@ -1,53 +1,257 @@
 import os
+import csv
+import hashlib
+import tempfile
 import numpy as np
 import simnibs
 import pyvista as pv
 from scipy.spatial import cKDTree
 
-def find_common_significant_nodes(
+# Per-subject MNI correspondence cache, in <m2m folder>/mni_correspondence: the MNI coordinates of the
+# result mesh nodes (and element barycentres) and, for each other subject, the index of its nearest node
+# (element) to every node (element) of this one. The result meshes of all types share the subject's
+# geometry, so both are computed once per subject (pair).
+CORRESPONDENCE_DIR = 'mni_correspondence'
+
+def save_npy(path, array):
+    # A temporary name unique to this call: concurrent runs may be filling the same cache entry.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp.npy')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def mni_coordinates(coords_subj, m2m_folder, kind, transformation_type='nonl'):
+    coords_subj = np.ascontiguousarray(coords_subj, dtype=np.float64)
+    key = hashlib.sha1(coords_subj.tobytes() + transformation_type.encode('utf-8')).hexdigest()[:16]
+    path = os.path.join(m2m_folder, CORRESPONDENCE_DIR, f'mni_{kind}_{key}.npy')
+    if os.path.exists(path):
+        return key, np.load(path)
+    coords_mni = simnibs.subject2mni_coords(
+        coords_subj,
+        m2m_folder,
+        transformation_type=transformation_type
+    ).astype(np.float32)
+    save_npy(path, coords_mni)
+    return key, coords_mni
+
+def mni_node_coordinates(mesh, m2m_folder, transformation_type='nonl'):
+    return mni_coordinates(mesh.nodes[:, :3], m2m_folder, 'nodes', transformation_type)
+
+def mni_element_coordinates(mesh, m2m_folder, transformation_type='nonl'):
+    # Element barycentres: the rows of the Do_Corr statistics the result mesh was built from.
+    return mni_coordinates(mesh.elements_baricenters()[:], m2m_folder, 'elements', transformation_type)
+
+def nearest_nodes(ref_folder, ref_key, ref_coords_mni, m2m_folder, key, coords_mni):
+    subject = os.path.basename(os.path.normpath(m2m_folder))
+    path = os.path.join(ref_folder, CORRESPONDENCE_DIR, f'nearest_{ref_key}_{subject}_{key}.npy')
+    if os.path.exists(path):
+        return np.load(path)
+    _, idx_nearest = cKDTree(coords_mni).query(ref_coords_mni)
+    idx_nearest = idx_nearest.astype(np.int32)
+    save_npy(path, idx_nearest)
+    return idx_nearest
+
+def read_node_field(mesh, field_name, mesh_path):
+    field_data = mesh.field[field_name][:]
+    if field_data is None:
+        raise ValueError(f"Field {field_name} not found in mesh {mesh_path}.")
+    return field_data
+
+def precompute_correspondence(m2m_folders, mesh_paths, transformation_type='nonl'):
+    # Fills the cache for every reference choice: all subjects' MNI coordinates, then all ordered pairs.
+    coordinates = []
+    for m2m_folder, mesh_path in zip(m2m_folders, mesh_paths):
+        coordinates.append(mni_node_coordinates(simnibs.read_msh(mesh_path), m2m_folder, transformation_type))
+    for ref_folder, (ref_key, ref_coords_mni) in zip(m2m_folders, coordinates):
+        for m2m_folder, (key, coords_mni) in zip(m2m_folders, coordinates):
+            if m2m_folder != ref_folder:
+                nearest_nodes(ref_folder, ref_key, ref_coords_mni, m2m_folder, key, coords_mni)
+
+def mapped_node_values(
     m2m_folders,
     mesh_paths,
     field_name='-negLog10Pvalues',
-    threshold=1.2,
     reference_index=0,
     transformation_type='nonl'
 ):
+    # Subjects x reference nodes: each subject's field at its node nearest to every reference node in MNI space.
     ref_mesh_path = mesh_paths[reference_index]
     ref_mesh = simnibs.read_msh(ref_mesh_path)
-    ref_coords_subj = ref_mesh.nodes[:, :3]
-    ref_coords_mni = simnibs.subject2mni_coords(
-        ref_coords_subj,
-        m2m_folders[reference_index],
-        transformation_type=transformation_type
-    )
-    ref_field_data = ref_mesh.field[field_name][:]
-    if ref_field_data is None:
-        raise ValueError(f"Field {field_name} not found in reference mesh.")
-    ref_significant_mask = (ref_field_data > threshold)
-    ref_kdtree = cKDTree(ref_coords_mni)
+    ref_folder = m2m_folders[reference_index]
+    ref_key, ref_coords_mni = mni_node_coordinates(ref_mesh, ref_folder, transformation_type)
+    ref_field_data = read_node_field(ref_mesh, field_name, ref_mesh_path)
+    values = np.empty((len(m2m_folders), ref_coords_mni.shape[0]), dtype=ref_field_data.dtype)
+    values[reference_index] = ref_field_data
     for i, m2m_folder in enumerate(m2m_folders):
         if i == reference_index:
             continue
         mesh = simnibs.read_msh(mesh_paths[i])
-        coords_subj = mesh.nodes[:, :3]
-        coords_mni = simnibs.subject2mni_coords(
-            coords_subj,
-            m2m_folder,
-            transformation_type=transformation_type
-        )
-        subj_field_data = mesh.field[field_name][:]
-        if subj_field_data is None:
-            raise ValueError(f"Field {field_name} not found in mesh {mesh_paths[i]}.")
-        subj_significant_mask = (subj_field_data > threshold)
-        subj_kdtree = cKDTree(coords_mni)
-        idx_ref_sign = np.where(ref_significant_mask)[0]
-        ref_sign_coords = ref_coords_mni[idx_ref_sign]
-        _, idx_nearest = subj_kdtree.query(ref_sign_coords)
-        ref_significant_mask[idx_ref_sign] = subj_significant_mask[idx_nearest]
-        common_mni_coords = ref_coords_mni[ref_significant_mask]
-        
+        key, coords_mni = mni_node_coordinates(mesh, m2m_folder, transformation_type)
+        idx_nearest = nearest_nodes(ref_folder, ref_key, ref_coords_mni, m2m_folder, key, coords_mni)
+        values[i] = read_node_field(mesh, field_name, mesh_paths[i])[idx_nearest]
+    return ref_mesh, ref_key, ref_coords_mni, values
+
+def find_common_significant_nodes(
+    m2m_folders,
+    mesh_paths,
+    field_name='-negLog10Pvalues',
+    threshold=1.2,
+    reference_index=0,
+    transformation_type='nonl'
+):
+    # A reference node is kept if it and, in every other subject, the nearest node in MNI space are significant.
+    ref_mesh, _, ref_coords_mni, values = mapped_node_values(
+        m2m_folders, mesh_paths, field_name, reference_index, transformation_type)
+    ref_significant_mask = (values > threshold).all(axis=0)
+    common_mni_coords = ref_coords_mni[ref_significant_mask]
+
     return ref_mesh, ref_significant_mask, common_mni_coords
 
+def kth_largest(values, ks):
+    # Row j holds, for every node, the ks[j]-th largest value across subjects: a node exceeds a threshold
+    # in at least k subjects exactly when its k-th largest value does.
+    ordered = -np.sort(-values, axis=0)
+    return ordered[np.asarray(ks) - 1]
+
+def conjunction_sweep(kth, thresholds):
+    # kth: types x ks x nodes. Returns every (type, threshold, k) conjunction map as a bitset packed along
+    # the nodes, types x thresholds x ks x bytes, and the number of nodes in each map.
+    n_types, n_ks, n_nodes = kth.shape
+    packed = np.empty((n_types, len(thresholds), n_ks, (n_nodes + 7) // 8), dtype=np.uint8)
+    counts = np.empty((n_types, len(thresholds), n_ks), dtype=np.int64)
+    for i, threshold in enumerate(thresholds):
+        maps = kth > threshold
+        counts[:, i] = maps.sum(axis=2)
+        packed[:, i] = np.packbits(maps, axis=2)
+    return packed, counts
+
+def save_conjunction_sweep(output_path, packed, counts, types, thresholds, ks, subjects, reference, n_nodes):
+    np.savez(output_path, packed=packed, counts=counts, types=np.asarray(types), thresholds=np.asarray(thresholds),
+             ks=np.asarray(ks), subjects=np.asarray(subjects), reference=reference, n_nodes=n_nodes)
+    table_path = output_path[:-len('.npz')] + '.csv'
+    with open(table_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Type', 'Threshold', 'K', 'NSubjects', 'NNodes'])
+        for t, attr_type in enumerate(types):
+            for i, threshold in enumerate(thresholds):
+                for j, k in enumerate(ks):
+                    writer.writerow([attr_type, threshold, k, len(subjects), counts[t, i, j]])
+    print("Wrote conjunction sweep to:", output_path, "and", table_path)
+
+def load_conjunction_map(sweep_path, attr_type, threshold, k):
+    with np.load(sweep_path) as sweep:
+        t = list(sweep['types']).index(attr_type)
+        i = int(np.flatnonzero(np.isclose(sweep['thresholds'], threshold))[0])
+        j = list(sweep['ks']).index(k)
+        return np.unpackbits(sweep['packed'][t, i, j], count=int(sweep['n_nodes'])).astype(bool)
+
+def supra_masks_path(supra_path):
+    return supra_path[:-len('.npz')] + 'Masks.npy'
+
+def load_supra_sets(supra_path):
+    # Written by Do_Corr_Percentiles_GenMesh_345.py: row b of the memory-mapped masks holds the
+    # supra-threshold rows of permutation b as packed bits.
+    with np.load(supra_path) as f:
+        sets = {name: f[name] for name in f.files}
+    sets['masks'] = np.load(supra_masks_path(supra_path), mmap_mode='r')
+    return sets
+
+def supra_rows(sets, b):
+    return np.flatnonzero(np.unpackbits(sets['masks'][b], count=int(sets['n_rows'])))
+
+def preimage(idx_nearest, n_elements):
+    # CSR from every element of a subject to the reference elements that take it as their nearest one.
+    order = np.argsort(idx_nearest, kind='stable').astype(np.int32)
+    indptr = np.zeros(n_elements + 1, dtype=np.int64)
+    np.cumsum(np.bincount(idx_nearest, minlength=n_elements), out=indptr[1:])
+    return indptr, order
+
+def gather_rows(indptr, indices, rows):
+    # Concatenation of indices[indptr[r]:indptr[r + 1]] over rows, without a Python loop.
+    starts = indptr[rows]
+    lengths = indptr[np.asarray(rows) + 1] - starts
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+    return indices[offsets]
+
+def conjunction_sizes(preimages, subject_rows, n_ref, ks):
+    # Reference elements supra-threshold in at least k subjects, for every k: each subject's rows are mapped
+    # onto the reference elements, then the per-element subject counts are histogrammed.
+    mapped = [gather_rows(indptr, order, rows) for (indptr, order), rows in zip(preimages, subject_rows)]
+    counts = np.bincount(np.concatenate(mapped), minlength=n_ref)
+    at_least = np.cumsum(np.bincount(counts, minlength=len(subject_rows) + 1)[::-1])[::-1]
+    return at_least[np.asarray(ks)], counts
+
+def spatial_conjunction_null(
+    m2m_folders,
+    mesh_paths,
+    supra_paths,
+    ks,
+    reference_index=0,
+    transformation_type='nonl'
+):
+    """Permutation null of the conjunction built from every subject's stored supra-threshold sets.
+    All subjects were permuted with the same seeded permutations of the shared studies, so permutation b
+    of every subject is one draw of the joint null: mapping its sets to the reference elements and
+    intersecting them gives the null conjunction, with the spatial dependence within and across subjects
+    intact. Returns the observed and per-permutation conjunction sizes for every k and the settings."""
+    sets = [load_supra_sets(path) for path in supra_paths]
+    for name in ('permutation_key', 'threshold', 'critical', 'statistic', 'alternative'):
+        values = {sets_i[name].item() for sets_i in sets}
+        if len(values) > 1:
+            raise ValueError(f"The supra-threshold sets of the subjects differ in {name}; rerun the "
+                             f"statistics of all subjects with the same settings")
+    ref_mesh_path = mesh_paths[reference_index]
+    ref_mesh = simnibs.read_msh(ref_mesh_path)
+    ref_folder = m2m_folders[reference_index]
+    ref_key, ref_coords_mni = mni_element_coordinates(ref_mesh, ref_folder, transformation_type)
+    n_ref = ref_coords_mni.shape[0]
+    preimages = []
+    for i, m2m_folder in enumerate(m2m_folders):
+        if i == reference_index:
+            mesh, idx_nearest = ref_mesh, np.arange(n_ref, dtype=np.int32)
+        else:
+            mesh = simnibs.read_msh(mesh_paths[i])
+            key, coords_mni = mni_element_coordinates(mesh, m2m_folder, transformation_type)
+            idx_nearest = nearest_nodes(ref_folder, ref_key, ref_coords_mni, m2m_folder, key, coords_mni)
+        if sets[i]['n_rows'] != mesh.elm.nelm:
+            raise ValueError(f"{supra_paths[i]} has {sets[i]['n_rows']} rows but {mesh_paths[i]} has "
+                             f"{mesh.elm.nelm} elements")
+        preimages.append(preimage(idx_nearest, mesh.elm.nelm))
+    observed_sizes, observed_counts = conjunction_sizes(preimages, [s['observed'] for s in sets], n_ref, ks)
+    n_permutations = sets[0]['masks'].shape[0]
+    null_sizes = np.empty((n_permutations, len(ks)), dtype=np.int64)
+    for b in range(n_permutations):
+        null_sizes[b] = conjunction_sizes(preimages, [supra_rows(s, b) for s in sets], n_ref, ks)[0]
+    return {
+        'observed_sizes': observed_sizes,
+        'observed_counts': observed_counts,
+        'null_sizes': null_sizes,
+        'threshold': sets[0]['threshold'].item(),
+        'critical': sets[0]['critical'].item(),
+    }
+
+def spatial_null_pvalues(observed_sizes, null_sizes):
+    # FWER: the fraction of permutations with any conjunction element, which is the error rate of reporting
+    # the observed map. Extent: the fraction whose conjunction is at least as large as the observed one.
+    fwer = np.mean(null_sizes > 0, axis=0)
+    p_extent = np.where(observed_sizes > 0, np.mean(null_sizes >= observed_sizes[None, :], axis=0), 1.0)
+    return fwer, p_extent
+
+def save_spatial_null(output_path, null, ks, subjects, reference):
+    fwer, p_extent = spatial_null_pvalues(null['observed_sizes'], null['null_sizes'])
+    np.savez(output_path, ks=np.asarray(ks), observed_sizes=null['observed_sizes'], null_sizes=null['null_sizes'],
+             fwer=fwer, p_extent=p_extent, threshold=null['threshold'], critical=null['critical'],
+             observed_counts=null['observed_counts'], subjects=np.asarray(subjects), reference=reference)
+    for j, k in enumerate(ks):
+        print(f"k={k}: {null['observed_sizes'][j]} conjunction elements at -log10(p) > {null['threshold']}, "
+              f"FWER {fwer[j]:.4f}, extent p {p_extent[j]:.4f} over {null['null_sizes'].shape[0]} permutations")
+    print("Wrote spatial conjunction null to:", output_path)
+
 def save_mni_nodes_as_mesh(mni_coords, output_path):
     if mni_coords.shape[0] == 0:
         print("Warning: No common significant nodes found. MNI file will not be saved.")
@@ -69,39 +273,111 @@ def map_common_significant_to_reference_subject_space(
 
     ref_mesh.write(output_msh_path)
 
-if __name__ == "__main__":
-    basepath = r"D:\tDCS_PEC_Python\HeadMeshes"
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Nodes significant in every subject, mapped through MNI space.")
+    parser.add_argument("headmeshes_dir", nargs='?', default=r"D:\tDCS_PEC_Python\HeadMeshes",
+                        help="Folder holding the m2m_* subject folders.")
+    parser.add_argument("--types", nargs='+', default=["ToM"], help="Attribute types of the result meshes.")
+    parser.add_argument("--mesh-name", default="{type}_result_mesh.msh",
+                        help="Result mesh file name in allMeshes/ResultMesh/<type>, formatted with the type.")
+    parser.add_argument("--reference", help="Reference subject folder (default: the ninth subject).")
+    parser.add_argument("--output-dir", help="Output folder (default: the reference subject folder).")
+    parser.add_argument("--all-references", action="store_true",
+                        help="Also cache the nearest-node maps of every other reference subject.")
+    parser.add_argument("--thresholds", nargs='+', type=float, default=[1.2],
+                        help="-log10(p) thresholds of the sweep; the first one goes into the output meshes.")
+    parser.add_argument("--k", nargs='+', type=int,
+                        help="Minimum numbers of significant subjects of the sweep (default: all subjects); "
+                             "the first one goes into the output meshes.")
+    parser.add_argument("--spatial-null", action="store_true",
+                        help="Also test the conjunction against the permutation null built from the subjects' "
+                             "stored supra-threshold sets.")
+    parser.add_argument("--supra-name", default="{type}_base_permSupra.npz",
+                        help="Supra-threshold set file in correlations/<type>, formatted with the type.")
+    args = parser.parse_args(argv)
+
+    basepath = args.headmeshes_dir
     m2m_folders = [
         os.path.join(basepath, d)
-        for d in os.listdir(basepath)
+        for d in sorted(os.listdir(basepath))
         if d.startswith("m2m_") and os.path.isdir(os.path.join(basepath, d))
     ]
-    mesh_paths = [
-        os.path.join(folder, "allMeshes", "ResultMesh", "ToM", "ToM_result_mesh.msh")
-        for folder in m2m_folders
-    ]
+    subjects = [os.path.basename(folder) for folder in m2m_folders]
+    ks = args.k or [len(m2m_folders)]
+    if not all(1 <= k <= len(m2m_folders) for k in ks):
+        raise ValueError(f"--k must be between 1 and the number of subjects ({len(m2m_folders)})")
     reference_index = 8
-    ref_mesh, ref_significant_mask, common_mni_coords = find_common_significant_nodes(
-        m2m_folders,
-        mesh_paths,
-        reference_index=reference_index,
-    )
-    output_mesh_path = os.path.join(
-        m2m_folders[reference_index],
-        "common_significance_reference_subject.msh"
-    )
-    map_common_significant_to_reference_subject_space(
-        ref_mesh,
-        ref_significant_mask,
-        m2m_folders[reference_index],
-        output_mesh_path,
-        transformation_type='nonl'
-    )
-    output_mni_path = os.path.join(
-        m2m_folders[reference_index],
-        "common_significance_MNI_nodes.vtk"
-    )
-    save_mni_nodes_as_mesh(common_mni_coords, output_mni_path)
-
-    print("Wrote combined significance mask to:", output_mesh_path)
-    print("Wrote MNI significance mask to:", output_mni_path)
+    if args.reference is not None:
+        reference_index = subjects.index(args.reference)
+    output_dir = args.output_dir or m2m_folders[reference_index]
+    os.makedirs(output_dir, exist_ok=True)
+
+    kth = []
+    ref_keys = set()
+    for attr_type in args.types:
+        mesh_paths = [
+            os.path.join(folder, "allMeshes", "ResultMesh", attr_type, args.mesh_name.format(type=attr_type))
+            for folder in m2m_folders
+        ]
+        if args.all_references:
+            precompute_correspondence(m2m_folders, mesh_paths)
+        ref_mesh, ref_key, ref_coords_mni, values = mapped_node_values(
+            m2m_folders,
+            mesh_paths,
+            reference_index=reference_index,
+        )
+        ref_keys.add(ref_key)
+        if len(ref_keys) > 1:
+            raise ValueError(f"The {attr_type} result mesh of {subjects[reference_index]} has different nodes "
+                             f"from its other types; the sweep needs one node set")
+        kth.append(kth_largest(values, ks))
+        del values
+        ref_significant_mask = kth[-1][0] > args.thresholds[0]
+        common_mni_coords = ref_coords_mni[ref_significant_mask]
+        output_mesh_path = os.path.join(
+            output_dir,
+            f"common_significance_reference_subject_{attr_type}.msh"
+        )
+        map_common_significant_to_reference_subject_space(
+            ref_mesh,
+            ref_significant_mask,
+            m2m_folders[reference_index],
+            output_mesh_path,
+            transformation_type='nonl'
+        )
+        output_mni_path = os.path.join(
+            output_dir,
+            f"common_significance_MNI_nodes_{attr_type}.vtk"
+        )
+        save_mni_nodes_as_mesh(common_mni_coords, output_mni_path)
+
+        print("Wrote combined significance mask to:", output_mesh_path)
+        print("Wrote MNI significance mask to:", output_mni_path)
+
+        if args.spatial_null:
+            supra_paths = [
+                os.path.join(folder, "correlations", attr_type, args.supra_name.format(type=attr_type))
+                for folder in m2m_folders
+            ]
+            spatial_null_path = os.path.join(output_dir, f"common_significance_spatial_null_{attr_type}.npz")
+            missing = [os.path.basename(folder) for folder, path in zip(m2m_folders, supra_paths)
+                       if not (os.path.exists(path) and os.path.exists(supra_masks_path(path)))]
+            if missing:
+                # Do_Corr keeps no supra-threshold sets for weighted statistics or with adaptive stopping.
+                print(f"Warning: No {attr_type} supra-threshold sets for {', '.join(missing)}. "
+                      f"The spatial null will not be computed.")
+                if os.path.exists(spatial_null_path):
+                    os.remove(spatial_null_path)
+            else:
+                null = spatial_conjunction_null(m2m_folders, mesh_paths, supra_paths, ks, reference_index=reference_index)
+                save_spatial_null(spatial_null_path, null, ks, subjects, subjects[reference_index])
+
+    kth = np.stack(kth)
+    packed, counts = conjunction_sweep(kth, args.thresholds)
+    sweep_path = os.path.join(output_dir, f"common_significance_sweep_{'_'.join(args.types)}.npz")
+    save_conjunction_sweep(sweep_path, packed, counts, args.types, args.thresholds, ks, subjects,
+                           subjects[reference_index], kth.shape[2])
+
+if __name__ == "__main__":
+    main()
@@ -66,14 +66,22 @@ def generate_4_view_figure(mesh_path, variable_name, output_path):
     plt.close(fig)
 
 
-if __name__ == "__main__":
-    files_to_process = {
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Render the four standard views of a significance mesh.")
+    parser.add_argument("meshes", nargs='*', metavar="NAME=MESH",
+                        help="Meshes to render, each saved as <NAME>_significance_views-NEW.pdf.")
+    parser.add_argument("--field", default="-common_significance", help="Node field to display.")
+    parser.add_argument("--output-dir", default=r"C:\Users\Gabma\OneDrive\Dokumente\tDCS_PEC_Python\HeadMeshes\AutomatedFigures\Significance")
+    args = parser.parse_args(argv)
+
+    files_to_process = dict(mesh.split('=', 1) for mesh in args.meshes) or {
         "ToM": r"C:\Users\Gabma\OneDrive\Dokumente\tDCS_PEC_Python\HeadMeshes\m2m_ernie\CombinedP\common_significance_reference_subject_ToM_10.msh",
         "Empathy": r"C:\Users\Gabma\OneDrive\Dokumente\tDCS_PEC_Python\HeadMeshes\m2m_ernie\CombinedP\common_significance_reference_subject_Empathy_10.msh"
     }
     
-    variable_field = "-common_significance"
-    output_directory = r"C:\Users\Gabma\OneDrive\Dokumente\tDCS_PEC_Python\HeadMeshes\AutomatedFigures\Significance"
+    variable_field = args.field
+    output_directory = args.output_dir
     os.makedirs(output_directory, exist_ok=True)
     print("--- Starting Figure Generation ---")
     for name, file_path in files_to_process.items():
@@ -84,4 +92,8 @@ if __name__ == "__main__":
             output_path=output_filename
         )
         
-    print("\n--- All tasks complete! ---")
\ No newline at end of file
+    print("\n--- All tasks complete! ---")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,60 +1,371 @@
 import subprocess
 import sys
 import os
+import time
+import json
+import hashlib
+import gc
+import importlib
+import traceback
+import sqlite3
+import multiprocessing
+import concurrent.futures
+from threadpoolctl import threadpool_limits
 
-def run_script(script_name, args=None):
-    """Runs a Python script and handles errors."""
-    print(f"\nRunning {script_name}...")
+ATTRIBUTE_TYPES = ['ToM', 'Altruism', 'Empathy']
+
+# Thread-count variables of the BLAS and OpenMP runtimes numpy and SimNIBS may be linked against.
+BLAS_THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+                         'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+# Pipeline stages in order. cores and ram_gb are the budget a node reserves (clamped to the machine budget);
+# the cores are passed to the script through cores_flag, and blas is whether the node's worker process gets
+# them as BLAS threads (scripts with worker pools pin their workers).
+# The simulations of a subject stay one node: its types share the montage cache and lead fields.
+STAGES = {
+    'transform': {'script': 'TransformEEGelectrodes.py', 'cores_flag': None, 'cores': 1, 'ram_gb': 2, 'blas': True},
+    'simulate': {'script': 'simFromCSV_step1.py', 'cores_flag': '--cpus', 'cores': 16, 'ram_gb': 16, 'blas': True},
+    'extract': {'script': 'meshToNpy_step2.py', 'cores_flag': '--workers', 'cores': 4, 'ram_gb': 8, 'blas': False},
+    'correlate': {'script': 'Do_Corr_Percentiles_GenMesh_345.py', 'cores_flag': '--cores', 'cores': 20, 'ram_gb': 32, 'blas': False},
+    'mesh': {'script': 'Do_Corr_Percentiles_GenMesh_345.py', 'cores_flag': None, 'cores': 1, 'ram_gb': 8, 'blas': True},
+    'combine': {'script': 'do_combinedP.py', 'cores_flag': None, 'cores': 1, 'ram_gb': 8, 'blas': True},
+    'render': {'script': 'generate4views_CommonSignificance.py', 'cores_flag': None, 'cores': 1, 'ram_gb': 4, 'blas': True},
+}
+
+def total_memory_gb():
     try:
-        command = [sys.executable, script_name]
-        if args:
-            command.extend(args)
-        result = subprocess.run(command, check=True)
-        print(f"{script_name} completed successfully.\n")
-    except subprocess.CalledProcessError as e:
-        print(f"Error while running {script_name}: {e}")
-        sys.exit(1)
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+    except (AttributeError, ValueError, OSError):
+        pass
+    import ctypes
+
+    class MEMORYSTATUSEX(ctypes.Structure):
+        _fields_ = [('dwLength', ctypes.c_ulong), ('dwMemoryLoad', ctypes.c_ulong),
+                    ('ullTotalPhys', ctypes.c_ulonglong), ('ullAvailPhys', ctypes.c_ulonglong),
+                    ('ullTotalPageFile', ctypes.c_ulonglong), ('ullAvailPageFile', ctypes.c_ulonglong),
+                    ('ullTotalVirtual', ctypes.c_ulonglong), ('ullAvailVirtual', ctypes.c_ulonglong),
+                    ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+
+    status = MEMORYSTATUSEX()
+    status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+    ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+    return status.ullTotalPhys / 1024 ** 3
+
+def build_graph(subjects, stages, basePath, headmeshes_dir, erniePath, data_filepath, total_cores, total_ram_gb):
+    """The stage graph: one node per (subject, stage, type) with the files it reads and writes. A node depends
+    on the nodes writing its inputs (or a folder holding them); nodes are listed in dependency order."""
+    nodes = []
+
+    def add(stage, subject, attr_type, argv, inputs, outputs):
+        if stage not in stages:
+            return
+        spec = STAGES[stage]
+        cores = max(1, min(spec['cores'], total_cores))
+        nodes.append({
+            'id': f"{subject}/{stage}/{attr_type or '-'}",
+            'subject': subject,
+            'stage': stage,
+            'type': attr_type,
+            'script': spec['script'],
+            'argv': argv,
+            'cores_flag': spec['cores_flag'],
+            'cores': cores,
+            'ram_gb': min(spec['ram_gb'], total_ram_gb),
+            'blas_threads': cores if spec['blas'] else 1,
+            'inputs': [os.path.normpath(path) for path in inputs],
+            'outputs': [os.path.normpath(path) for path in outputs],
+        })
+
+    reference = os.path.basename(os.path.normpath(erniePath))
+    for subject in subjects:
+        subpath = os.path.join(headmeshes_dir, subject)
+        base_path = os.path.join(subpath, 'allMeshes')
+        eeg_cap = os.path.join(subpath, "EEG10-20_Extended_SPM12.csv")
+        if os.path.normpath(subpath) != os.path.normpath(erniePath):
+            add('transform', subject, None, [subpath, erniePath],
+                [os.path.join(erniePath, 'EEG10-10_UI_Jurak_2007.csv'), os.path.join(erniePath, 'EEG10-20_extended_SPM12.csv'),
+                 os.path.join(subpath, 'EEG10-10_UI_Jurak_2007.csv')],
+                [eeg_cap])
+        add('simulate', subject, None, [subpath, eeg_cap, data_filepath, '--update'],
+            [eeg_cap, data_filepath],
+            [os.path.join(base_path, attr_type, 'simulated_studies.csv') for attr_type in ATTRIBUTE_TYPES])
+        for attr_type in ATTRIBUTE_TYPES:
+            type_path = os.path.join(base_path, attr_type)
+            matrices = [os.path.join(type_path, f'{attr_type}_matrice_totale_{variant}.npy')
+                        for variant in ['base', 'fsavg_overlays', 'subject_overlays']]
+            columns = [matrix[:-len('.npy')] + '_columns.csv' for matrix in matrices]
+            correlations = os.path.join(subpath, 'correlations', attr_type)
+            result_mesh = os.path.join(subpath, 'allMeshes', 'ResultMesh', attr_type, f'{attr_type}_base_result_mesh.msh')
+            # Overlays are written only for studies that have them, so only the base matrix is a required output;
+            # the overlay variants are correlated when they exist.
+            add('extract', subject, attr_type, [subpath, '--update', '--types', attr_type],
+                [os.path.join(type_path, 'simulated_studies.csv')], [matrices[0], columns[0]])
+            add('correlate', subject, attr_type, [subpath, data_filepath, '--types', attr_type, '--steps', 'statistics'],
+                matrices + columns + [data_filepath], [correlations])
+            add('mesh', subject, attr_type,
+                [subpath, data_filepath, '--types', attr_type, '--steps', 'mesh', '--result-dir', subpath],
+                [correlations] + matrices, [result_mesh])
+
+    # do_combinedP.py combines every m2m_* subject folder, so its inputs are all their result meshes and the
+    # supra-threshold sets of their permutations. Do_Corr keeps no sets for weighted statistics or adaptive
+    # stopping; do_combinedP then skips the spatial null, so its file is not a required output.
+    all_subjects = sorted(folder for folder in os.listdir(headmeshes_dir)
+                          if folder.startswith('m2m_') and os.path.isdir(os.path.join(headmeshes_dir, folder)))
+    combined_dir = os.path.join(erniePath, 'CombinedP')
+    figures_dir = os.path.join(basePath, 'AutomatedFigures', 'Significance')
+    combined_meshes = {attr_type: os.path.join(combined_dir, f'common_significance_reference_subject_{attr_type}.msh')
+                       for attr_type in ATTRIBUTE_TYPES}
+    # One node for all types: the threshold and k-of-n sweep stacks them into one pass and one file.
+    add('combine', 'all', None,
+        [headmeshes_dir, '--types'] + ATTRIBUTE_TYPES
+        + ['--mesh-name', '{type}_base_result_mesh.msh', '--reference', reference, '--output-dir', combined_dir,
+           '--spatial-null'],
+        [os.path.join(headmeshes_dir, subject, 'allMeshes', 'ResultMesh', attr_type, f'{attr_type}_base_result_mesh.msh')
+         for attr_type in ATTRIBUTE_TYPES for subject in all_subjects]
+        + [os.path.join(headmeshes_dir, subject, 'correlations', attr_type, f'{attr_type}_base_permSupra{suffix}')
+           for attr_type in ATTRIBUTE_TYPES for subject in all_subjects for suffix in ('.npz', 'Masks.npy')],
+        list(combined_meshes.values())
+        + [os.path.join(combined_dir, f"common_significance_sweep_{'_'.join(ATTRIBUTE_TYPES)}.npz")])
+    for attr_type in ATTRIBUTE_TYPES:
+        add('render', 'all', attr_type, [f'{attr_type}={combined_meshes[attr_type]}', '--output-dir', figures_dir],
+            [combined_meshes[attr_type]], [os.path.join(figures_dir, f'{attr_type}_significance_views-NEW.pdf')])
+
+    producers = {}
+    for node in nodes:
+        node['after'] = sorted({producers[path] for path in producers
+                                for input_path in node['inputs']
+                                if input_path == path or input_path.startswith(path + os.sep)})
+        producers.update({path: node['id'] for path in node['outputs']})
+    return nodes
+
+def open_journal(path):
+    # Node states and fingerprints survive the run, with a cache of file content hashes keyed by size and
+    # modification time so unchanged inputs are not read again.
+    journal = sqlite3.connect(path)
+    journal.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                           job TEXT PRIMARY KEY, subject TEXT, stage TEXT, type TEXT, state TEXT,
+                           attempts INTEGER DEFAULT 0, returncode INTEGER, started REAL, finished REAL, log TEXT)""")
+    if 'fingerprint' not in [row[1] for row in journal.execute("PRAGMA table_info(jobs)")]:
+        journal.execute("ALTER TABLE jobs ADD COLUMN fingerprint TEXT")
+    journal.execute("""CREATE TABLE IF NOT EXISTS file_hashes (
+                           path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)""")
+    journal.commit()
+    return journal
+
+def record_job(journal, job, state, **fields):
+    journal.execute("INSERT OR IGNORE INTO jobs (job, subject, stage, type) VALUES (?, ?, ?, ?)",
+                    (job['id'], job['subject'], job['stage'], job['type']))
+    assignments = ', '.join(f"{name} = ?" for name in ['state'] + list(fields))
+    journal.execute(f"UPDATE jobs SET {assignments} WHERE job = ?", [state] + list(fields.values()) + [job['id']])
+    journal.commit()
+
+def file_hash(journal, path, chunkSize=1 << 20):
+    stat = os.stat(path)
+    row = journal.execute("SELECT size, mtime_ns, hash FROM file_hashes WHERE path = ?", (path,)).fetchone()
+    if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+        return row[2]
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunkSize), b''):
+            h.update(block)
+    journal.execute("INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, hash) VALUES (?, ?, ?, ?)",
+                    (path, stat.st_size, stat.st_mtime_ns, h.hexdigest()))
+    journal.commit()
+    return h.hexdigest()
+
+def path_hash(journal, path):
+    # Content hash of a file, or of every file below a folder with its relative path; None if missing.
+    if os.path.isfile(path):
+        return file_hash(journal, path)
+    if not os.path.isdir(path):
+        return None
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            h.update(os.path.relpath(file_path, path).replace(os.sep, '/').encode('utf-8'))
+            h.update(file_hash(journal, file_path).encode('utf-8'))
+    return h.hexdigest()
+
+def node_fingerprint(journal, node, base_dir):
+    # The stage, its parameters, the code of its script and the content of its inputs. The core count is
+    # left out: it changes how fast a node runs, not what it writes.
+    return hashlib.sha1(json.dumps({
+        'stage': node['stage'],
+        'argv': node['argv'],
+        'code': file_hash(journal, os.path.join(base_dir, node['script'])),
+        'inputs': [[path, path_hash(journal, path)] for path in node['inputs']],
+    }).encode('utf-8')).hexdigest()
+
+def node_argv(node):
+    return node['argv'] + ([node['cores_flag'], str(node['cores'])] if node['cores_flag'] else [])
+
+def init_node_worker(base_dir):
+    # A pool worker is one interpreter for the whole run: the stage scripts it imports stay loaded for the
+    # next nodes it gets, so only the first node of each stage in a worker pays for numpy/SimNIBS imports.
+    sys.path.insert(0, base_dir)
+
+def run_node(node, log_path):
+    """Runs the script's main(argv) in this pool worker and returns its exit code. A worker runs one node at
+    a time, so the node owns the process while it runs: the standard file descriptors go to its log (also for
+    the processes it starts), and the BLAS pools and thread variables are set to its budget."""
+    argv = node_argv(node)
+    with open(log_path, 'a') as log:
+        log.write(f"\n=== {time.strftime('%Y-%m-%d %H:%M:%S')} {node['script']} {subprocess.list2cmdline(argv)}\n")
+        log.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved_fds = [os.dup(1), os.dup(2)]
+        saved_env = {name: os.environ.get(name) for name in BLAS_THREAD_VARIABLES}
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        os.environ.update({name: str(node['blas_threads']) for name in BLAS_THREAD_VARIABLES})
+        try:
+            # The variables cover a BLAS loaded by this node's first import; threadpoolctl the ones already loaded.
+            with threadpool_limits(node['blas_threads']):
+                module = importlib.import_module(os.path.splitext(node['script'])[0])
+                return module.main(argv) or 0
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except Exception:
+            traceback.print_exc()
+            return 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd, saved in zip((1, 2), saved_fds):
+                os.dup2(saved, fd)
+                os.close(saved)
+            for name, value in saved_env.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+            gc.collect()
+
+def start_workers(base_dir, total_cores):
+    # spawn on every platform, so workers start from a clean interpreter rather than a copy of the scheduler.
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max(1, total_cores),
+                                                  mp_context=multiprocessing.get_context('spawn'),
+                                                  initializer=init_node_worker, initargs=(base_dir,))
+
+def run_pipeline(nodes, journal, log_dir, base_dir, total_cores, total_ram_gb):
+    """Runs the stale nodes whose dependencies are done as long as their cores and RAM fit in the budget.
+    A node is up to date when its last run succeeded with the same fingerprint and its outputs exist.
+    Nodes run in a pool of persistent worker processes, one node per worker at a time, so a stage's process-wide
+    state (BLAS threads, pyplot, environment) is never shared by two running nodes. Returns the number of
+    failed or blocked nodes."""
+    states = {node['id']: 'pending' for node in nodes}
+    free_cores, free_ram_gb = total_cores, total_ram_gb
+    running = {}
+    executor = start_workers(base_dir, total_cores)
+    try:
+        while True:
+            # Nodes are in dependency order, so a failure propagates to all its dependents in one pass.
+            for node in nodes:
+                if states[node['id']] != 'pending':
+                    continue
+                after = [states[node_id] for node_id in node['after']]
+                if any(state in ('failed', 'blocked') for state in after):
+                    states[node['id']] = 'blocked'
+                    record_job(journal, node, 'blocked')
+                    print(f"Not running {node['id']}: an earlier stage failed")
+                    continue
+                if any(state != 'done' for state in after):
+                    continue
+                if node['cores'] > free_cores or node['ram_gb'] > free_ram_gb:
+                    continue
+                # Computed only now that the inputs written by earlier nodes are final.
+                fingerprint = node_fingerprint(journal, node, base_dir)
+                row = journal.execute("SELECT state, fingerprint, attempts FROM jobs WHERE job = ?", (node['id'],)).fetchone()
+                if (row is not None and row[0] == 'done' and row[1] == fingerprint
+                        and all(os.path.exists(path) for path in node['outputs'])):
+                    states[node['id']] = 'done'
+                    print(f"{node['id']} is up to date")
+                    continue
+                free_cores -= node['cores']
+                free_ram_gb -= node['ram_gb']
+                states[node['id']] = 'running'
+                log_path = os.path.join(log_dir, node['id'].replace('/', '_') + '.log')
+                record_job(journal, node, 'running', attempts=(row[2] or 0) + 1 if row else 1, fingerprint=fingerprint,
+                           started=time.time(), finished=None, returncode=None, log=log_path)
+                print(f"Started {node['id']} ({node['cores']} cores, {node['ram_gb']:g} GB)")
+                running[executor.submit(run_node, node, log_path)] = (node, time.time(), log_path, executor)
+
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                node, start_time, log_path, node_executor = running.pop(future)
+                free_cores += node['cores']
+                free_ram_gb += node['ram_gb']
+                try:
+                    returncode = future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    # A worker died (crash, out of memory): every node running in the pool fails with it, and
+                    # the remaining nodes get a fresh pool.
+                    print(f"Error: the worker process running {node['id']} ended abruptly, see {log_path}")
+                    returncode = -1
+                    if node_executor is executor:
+                        executor.shutdown(wait=False)
+                        executor = start_workers(base_dir, total_cores)
+                missing = [path for path in node['outputs'] if not os.path.exists(path)]
+                states[node['id']] = 'done' if returncode == 0 and not missing else 'failed'
+                record_job(journal, node, states[node['id']], returncode=returncode, finished=time.time())
+                if states[node['id']] == 'done':
+                    print(f"{node['id']} completed successfully in {time.time() - start_time:.0f} s.")
+                elif returncode == 0:
+                    print(f"Error: {node['id']} did not write {', '.join(missing)}, see {log_path}")
+                elif returncode != -1:
+                    print(f"Error while running {node['id']} (exit code {returncode}), see {log_path}")
+    finally:
+        executor.shutdown()
+
+    return sum(state in ('failed', 'blocked') for state in states.values())
 
 if __name__ == "__main__":
-    basePath = r'D:\tDCS_PEC_Python'
-    base_dir = os.path.join(basePath, 'Code') 
-    headmeshes_dir = os.path.join(basePath, 'HeadMeshes')  
-    data_filepath = os.path.join(basePath, 'data', 'allData.csv')  
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the stale nodes of the tDCS pipeline graph.")
+    parser.add_argument("--base-path", default=r'D:\tDCS_PEC_Python', help="Folder holding Code, HeadMeshes and data.")
+    parser.add_argument("--subjects", nargs='+',
+                        help="Subject folders in HeadMeshes to process (default: all m2m_* folders).")
+    parser.add_argument("--stages", nargs='+', choices=list(STAGES), default=list(STAGES),
+                        help="Stages to consider; the outputs of the others are taken as they are.")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="Cores shared by all running nodes.")
+    parser.add_argument("--ram-gb", type=float, help="RAM shared by all running nodes (default: all of it).")
+    parser.add_argument("--journal", help="SQLite journal (default: <base-path>/pipeline/journal.sqlite).")
+    parser.add_argument("--restart", action="store_true",
+                        help="Forget the journal of the selected nodes and run them all again.")
+    args = parser.parse_args()
+
+    basePath = args.base_path
+    base_dir = os.path.join(basePath, 'Code')
+    headmeshes_dir = os.path.join(basePath, 'HeadMeshes')
+    data_filepath = os.path.join(basePath, 'data', 'allData.csv')
     erniePath = os.path.join(basePath, 'HeadMeshes', 'm2m_ernie')
+    pipeline_dir = os.path.join(basePath, 'pipeline')
+    log_dir = os.path.join(pipeline_dir, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
 
-    scripts = [
-        os.path.join(base_dir, "TransformEEGelectrodes.py"),
-        os.path.join(base_dir, "simFromCSV_step1.py"),
-        os.path.join(base_dir, "meshToNpy_step2.py"),
-        # os.path.join(base_dir, "Glasser_Corr_Percentiles_GenMesh_345.py"),
-        # os.path.join(base_dir, "runCorrPerm_3.py"),
-        os.path.join(base_dir, "Do_Corr_Percentiles_GenMesh_345.py"),
-        os.path.join(base_dir, "computePercentiles_4.py"),
-        os.path.join(base_dir, "generateMesh_5.py"),
-    ]
+    # The same m2m_* folders the combine stage takes as subjects.
+    subjects = args.subjects or sorted(folder for folder in os.listdir(headmeshes_dir)
+                                       if folder.startswith('m2m_') and os.path.isdir(os.path.join(headmeshes_dir, folder)))
+    total_ram_gb = args.ram_gb if args.ram_gb is not None else total_memory_gb()
+    nodes = build_graph(subjects, args.stages, basePath, headmeshes_dir, erniePath, data_filepath, args.cores, total_ram_gb)
+
+    journal = open_journal(args.journal or os.path.join(pipeline_dir, 'journal.sqlite'))
+    if args.restart:
+        journal.executemany("DELETE FROM jobs WHERE job = ?", [(node['id'],) for node in nodes])
+        journal.commit()
 
     print("Starting the SimNIBS pipeline execution.\n")
-    folders = os.listdir(headmeshes_dir)
-    # torunFolders = folders[8:9]
-    torunFolders = [folders[9]]
-
-    # Iterate through all subfolders in HeadMeshes
-    for folder in torunFolders:
-        subpath = os.path.join(headmeshes_dir, folder)
-        print(subpath)
-        if os.path.isdir(subpath):
-            print(f"Processing folder: {subpath}")
-            # eeg_cap = os.path.join(subpath, "EEG10-20_Extended_SPM12.csv")
-            # if subpath != erniePath:
-            #     run_script(scripts[0], [subpath, erniePath])
-
-            # Run the scripts sequentially for the current folder
-            # run_script(scripts[1], [subpath, eeg_cap, data_filepath])
-            # run_script(scripts[2], [subpath])
-            # run_script(scripts[1], [subpath, eeg_cap, data_filepath])
-            # run_script(scripts[2], [subpath])
-            run_script(scripts[3], [subpath, data_filepath])
-            # run_script(scripts[4], [subpath])
-            # run_script(scripts[5], [subpath])
-
-    print("\nPipeline execution completed successfully.")
\ No newline at end of file
+    print(f"{len(subjects)} subjects, {len(nodes)} nodes, {args.cores} cores, {total_ram_gb:.0f} GB")
+    n_failed = run_pipeline(nodes, journal, log_dir, base_dir, args.cores, total_ram_gb)
+    journal.close()
+    if n_failed:
+        print(f"\n{n_failed} nodes failed or were blocked; rerun to resume them.")
+        sys.exit(1)
+
+    print("\nPipeline execution completed successfully.")
@@ -1,126 +1,597 @@
 import os
 import glob
+import mmap
+import multiprocessing
+import struct
+import hashlib
 import numpy as np
+import pandas as pd
+import scipy.sparse
+from scipy.spatial import cKDTree
 import simnibs
 import shutil
 
-def create_matrice_totale(mesh_dir, overlay_subfolder=None, verbose=False):
-    if verbose:
-        if overlay_subfolder:
-            print(f"Starting to process mesh files in {mesh_dir} (overlay: {overlay_subfolder})...")
-        else:
-            print(f"Starting to process base mesh files in {mesh_dir}...")
+# Products of one study: (subfolder holding its .msh files, field to extract). The base product is read
+# from the study folder itself and cropped to the grey matter.
+VARIANTS = {
+    'base': (None, 'magnE'),
+    'fsavg_overlays': ('fsavg_overlays', 'E_magn'),
+    'subject_overlays': ('subject_overlays', 'E_magn'),
+}
+
+# Grey matter magnE written by simFromCSV_step1.py for studies built from lead fields.
+LEADFIELD_OUTPUT = 'leadfield_magnE_gm.npy'
+
+# Nodes per element of the gmsh element types that occur in head meshes.
+GMSH_ELEMENT_NODES = {1: 2, 2: 3, 3: 4, 4: 4, 5: 8, 6: 6, 7: 5, 15: 1}
+
+class MshFormatError(ValueError):
+    pass
+
+def _read_line(buf, pos):
+    end = buf.find(b'\n', pos)
+    if end < 0:
+        raise MshFormatError("Unexpected end of file")
+    return buf[pos:end].strip(), end + 1
+
+def _skip_section(buf, pos, name):
+    end = buf.find(b'$End' + name, pos)
+    if end < 0:
+        raise MshFormatError(f"Section ${name.decode()} is not terminated")
+    return _read_line(buf, end)[1]
+
+def _index_nodes_v4(buf, pos):
+    num_blocks = struct.unpack_from('<Q', buf, pos)[0]
+    pos += 32
+    for _ in range(num_blocks):
+        dim, _, parametric, num_nodes = struct.unpack_from('<iiiQ', buf, pos)
+        pos += 20 + num_nodes * (8 + 8 * (3 + (dim if parametric else 0)))
+    return pos
+
+def _index_elements(buf, pos, version):
+    # Walks the element block headers only; the connectivity itself is jumped over.
+    blocks = []
+    if version < 4:
+        num_elements, pos = _read_line(buf, pos)
+        remaining = int(num_elements)
+        while remaining > 0:
+            elm_type, num_follow, num_tags = struct.unpack_from('<iii', buf, pos)
+            if elm_type not in GMSH_ELEMENT_NODES:
+                raise MshFormatError(f"Unsupported element type {elm_type}")
+            record = 1 + num_tags + GMSH_ELEMENT_NODES[elm_type]
+            blocks.append((pos + 12, elm_type, num_follow, num_tags, record))
+            pos += 12 + 4 * record * num_follow
+            remaining -= num_follow
+    else:
+        num_blocks = struct.unpack_from('<Q', buf, pos)[0]
+        pos += 32
+        for _ in range(num_blocks):
+            dim, entity, elm_type, num_in_block = struct.unpack_from('<iiiQ', buf, pos)
+            if elm_type not in GMSH_ELEMENT_NODES:
+                raise MshFormatError(f"Unsupported element type {elm_type}")
+            record = 1 + GMSH_ELEMENT_NODES[elm_type]
+            blocks.append((pos + 20, dim, entity, num_in_block, record))
+            pos += 20 + 8 * record * num_in_block
+    return blocks, pos
 
-    fields = []
-    mesh_files = []
-    
+def _index_entities_v4(buf, pos):
+    # Physical tag of every (dimension, entity), which is what tag1 is in a version 2 file.
+    counts = struct.unpack_from('<QQQQ', buf, pos)
+    pos += 32
+    physical = {}
+    for dim, count in enumerate(counts):
+        for _ in range(count):
+            entity = struct.unpack_from('<i', buf, pos)[0]
+            pos += 4 + 8 * (3 if dim == 0 else 6)
+            num_physical = struct.unpack_from('<Q', buf, pos)[0]
+            tags = struct.unpack_from(f'<{num_physical}i', buf, pos + 8)
+            pos += 8 + 4 * num_physical
+            physical[(dim, entity)] = tags[0] if tags else 0
+            if dim > 0:
+                num_bounding = struct.unpack_from('<Q', buf, pos)[0]
+                pos += 8 + 4 * num_bounding
+    return physical, pos
+
+def _index_data(buf, pos, kind):
+    num_strings, pos = _read_line(buf, pos)
+    strings = []
+    for _ in range(int(num_strings)):
+        line, pos = _read_line(buf, pos)
+        strings.append(line.decode().strip('"'))
+    num_reals, pos = _read_line(buf, pos)
+    for _ in range(int(num_reals)):
+        pos = _read_line(buf, pos)[1]
+    num_ints, pos = _read_line(buf, pos)
+    ints = []
+    for _ in range(int(num_ints)):
+        line, pos = _read_line(buf, pos)
+        ints.append(int(line))
+    num_components, num_entities = ints[1], ints[2]
+    # Entity tags are ints in the files gmsh and SimNIBS write; the end marker tells if they are wider.
+    for tag_size in (4, 8):
+        end = pos + num_entities * (tag_size + 8 * num_components)
+        if buf.find(b'$End' + kind, end, end + len(kind) + 8) >= 0:
+            break
+    else:
+        raise MshFormatError(f"Cannot size the ${kind.decode()} block of {strings[0] if strings else ''}")
+    entry = {'name': strings[0] if strings else '', 'kind': kind.decode(), 'offset': pos,
+             'count': num_entities, 'components': num_components, 'tag_size': tag_size}
+    return entry, end
+
+def index_msh(buf):
+    # Indexes the sections of a binary gmsh 2.2 or 4.1 file from their headers: binary payloads are jumped
+    # over, so nodes, elements and unused fields are never parsed.
+    index = {'version': None, 'elements': None, 'physical': None, 'data': []}
+    pos = 0
+    while pos < len(buf):
+        line, pos = _read_line(buf, pos)
+        if not line:
+            continue
+        if not line.startswith(b'$'):
+            raise MshFormatError(f"Expected a section at byte {pos}")
+        name = line[1:]
+        if name == b'MeshFormat':
+            header, pos = _read_line(buf, pos)
+            version, file_type, data_size = header.split()
+            if int(file_type) != 1 or int(data_size) != 8:
+                raise MshFormatError("Only binary files with 8-byte doubles are indexed")
+            if struct.unpack_from('<i', buf, pos)[0] != 1:
+                raise MshFormatError("Only little-endian files are indexed")
+            index['version'] = float(version)
+            if not (2.0 <= index['version'] < 3.0 or index['version'] == 4.1):
+                raise MshFormatError(f"Unsupported gmsh version {version.decode()}")
+            pos += 4
+        elif index['version'] is None:
+            raise MshFormatError("Missing $MeshFormat")
+        elif name == b'Nodes':
+            if index['version'] < 4:
+                num_nodes, pos = _read_line(buf, pos)
+                pos += int(num_nodes) * 28
+            else:
+                pos = _index_nodes_v4(buf, pos)
+        elif name == b'Elements':
+            index['elements'], pos = _index_elements(buf, pos, index['version'])
+        elif name == b'Entities' and index['version'] >= 4:
+            index['physical'], pos = _index_entities_v4(buf, pos)
+        elif name in (b'ElementData', b'NodeData'):
+            entry, pos = _index_data(buf, pos, name)
+            index['data'].append(entry)
+        pos = _skip_section(buf, pos, name)
+    return index
+
+# Element tags and grey-matter mask per element table, reused for every study a worker reads.
+_gray_matter_masks = {}
+
+def gray_matter_mask(buf, index, label=2):
+    # The selection depends only on the element tables, so it is keyed on a hash of their bytes: study meshes
+    # with the same elements (rescaled copies of one montage solve, studies re-read by --update) share it,
+    # while meshes that differ in their electrode elements get their own.
+    blocks = index['elements']
+    if blocks is None:
+        raise MshFormatError("No $Elements section")
+    h = hashlib.sha1()
+    with memoryview(buf) as view:
+        for block in blocks:
+            if index['version'] < 4:
+                offset, _, count, _, record = block
+                h.update(view[offset:offset + 4 * record * count])
+            else:
+                offset, _, _, count, record = block
+                h.update(view[offset:offset + 8 * record * count])
+    key = (index['version'], label, tuple(block[1:] for block in blocks),
+           tuple(sorted((index['physical'] or {}).items())), h.hexdigest())
+    if key not in _gray_matter_masks:
+        element_tags = []
+        labels = []
+        for block in blocks:
+            if index['version'] < 4:
+                offset, _, count, num_tags, record = block
+                table = np.frombuffer(buf, dtype='<i4', count=count * record, offset=offset).reshape(count, record)
+                element_tags.append(table[:, 0].astype(np.int64))
+                labels.append(table[:, 1].copy() if num_tags > 0 else np.zeros(count, dtype=np.int32))
+            else:
+                offset, dim, entity, count, record = block
+                table = np.frombuffer(buf, dtype='<u8', count=count * record, offset=offset).reshape(count, record)
+                element_tags.append(table[:, 0].astype(np.int64))
+                labels.append(np.full(count, (index['physical'] or {}).get((dim, entity), 0), dtype=np.int32))
+            del table
+        element_tags = np.concatenate(element_tags)
+        mask = np.concatenate(labels) == label
+        _gray_matter_masks[key] = (element_tags, mask)
+    return _gray_matter_masks[key]
+
+def read_msh_field(path, field_name, gray_matter=False):
+    # Returns one field of a binary gmsh file, memory-mapping only its data block, either for every
+    # entity in tag order or, with gray_matter, for the elements labelled 2 in mesh order like crop_mesh(2).
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        index = index_msh(buf)
+        entry = next((e for e in index['data'] if e['name'] == field_name), None)
+        if entry is None:
+            raise KeyError(f"'{field_name}' field")
+        record = np.dtype([('tag', f"<i{entry['tag_size']}"), ('value', '<f8', (entry['components'],))])
+        block = np.frombuffer(buf, dtype=record, count=entry['count'], offset=entry['offset'])
+        tags = block['tag'].astype(np.int64)
+        values = block['value'].copy()
+        del block
+        if values.shape[1] == 1:
+            values = values[:, 0]
+        if not gray_matter:
+            if np.any(np.diff(tags) < 0):
+                values = values[np.argsort(tags, kind='stable')]
+            return values
+        if entry['kind'] != 'ElementData':
+            raise MshFormatError(f"'{field_name}' is not element data")
+        element_tags, mask = gray_matter_mask(buf, index)
+    if not mask.any():
+        raise KeyError("Label 2 (gray matter)")
+    if np.array_equal(tags, element_tags):
+        return values[mask]
+    order = np.argsort(tags, kind='stable')
+    wanted = element_tags[mask]
+    position = np.minimum(np.searchsorted(tags, wanted, sorter=order), tags.shape[0] - 1)
+    if not np.array_equal(tags[order[position]], wanted):
+        raise MshFormatError(f"'{field_name}' does not cover every grey-matter element")
+    return values[order[position]]
+
+def read_study_field(file, overlay_subfolder, field_name):
+    # Fast path through read_msh_field; formats it does not index (ASCII, other versions) go through simnibs.
+    if file.endswith('.npy'):
+        return np.load(file)
     try:
-        type_folders = os.listdir(mesh_dir)
-    except Exception as e:
-        print(f"Error listing directory {mesh_dir}: {e}")
-        return None
-        
-    if verbose:
-        print("Found folders:", type_folders)
-    
-    for type_folder in type_folders:
-        type_path = os.path.join(mesh_dir, type_folder)
-        if not os.path.isdir(type_path):
+        return read_msh_field(file, field_name, gray_matter=overlay_subfolder is None)
+    except MshFormatError:
+        pass
+    mesh = simnibs.read_msh(file)
+    if overlay_subfolder is None:
+        try:
+            mesh = mesh.crop_mesh(2)
+        except KeyError:
+            raise KeyError("Label 2 (gray matter)")
+    try:
+        return np.asarray(mesh.field[field_name][:])
+    except KeyError:
+        raise KeyError(f"'{field_name}' field")
+
+def find_study_meshes(type_path, verbose=False, variants=VARIANTS):
+    # Studies are taken in sorted name order, the order of the groupby('Name') effect sizes they are
+    # correlated with.
+    study_meshes = []
+    for study in sorted(os.listdir(type_path)):
+        study_path = os.path.join(type_path, study)
+        if not os.path.isdir(study_path):
             continue
-        
-        if overlay_subfolder:
-            search_folder = os.path.join(type_path, overlay_subfolder)
-            pattern = os.path.join(search_folder, '*.msh')
+        meshes = {}
+        for variant in variants:
+            overlay_subfolder = VARIANTS[variant][0]
+            search_folder = study_path if overlay_subfolder is None else os.path.join(study_path, overlay_subfolder)
+            if not os.path.isdir(search_folder):
+                if verbose:
+                    print(f"Folder {search_folder} does not exist. Skipping...")
+                meshes[variant] = []
+                continue
+            found_files = sorted(glob.glob(os.path.join(search_folder, '*.msh')))
+            if not found_files and overlay_subfolder is None:
+                # Studies built by lead-field superposition only store their grey matter magnE.
+                found_files = sorted(glob.glob(os.path.join(search_folder, LEADFIELD_OUTPUT)))
+            if not found_files:
+                if verbose:
+                    print(f"No .msh files found in {search_folder}. Skipping and deleting...")
+                shutil.rmtree(study_path)
+                break
+            meshes[variant] = found_files
         else:
-            search_folder = type_path
-            pattern = os.path.join(search_folder, '*.msh')
+            study_meshes.append((study, meshes))
+    return study_meshes
 
-        if not os.path.exists(search_folder) or not os.path.isdir(search_folder):
+def has_leadfield_studies(type_path):
+    return any(os.path.exists(os.path.join(type_path, study, LEADFIELD_OUTPUT)) for study in os.listdir(type_path))
+
+def extract_study(task):
+    # Reads every mesh of one study once and returns, per variant, one column per file (None when the
+    # field could not be extracted) plus the folders to delete because their mesh could not be read.
+    study, meshes, verbose = task
+    columns = {}
+    remove_dirs = []
+    for variant, files in meshes.items():
+        overlay_subfolder, field_name = VARIANTS[variant]
+        columns[variant] = []
+        for file in files:
             if verbose:
-                print(f"Folder {search_folder} does not exist. Skipping...")
+                print(f"Processing {file}...")
+            field_data = None
+            try:
+                field_data = read_study_field(file, overlay_subfolder, field_name)
+            except KeyError as e:
+                print(f"{e.args[0]} not found in {file}. Skipping this file.")
+            except Exception as e:
+                print(f"Error reading {file}: {e}. Skipping this file.")
+                remove_dirs.append(os.path.dirname(file))
+            columns[variant].append((file, field_data))
+    return study, columns, remove_dirs
+
+def drop_columns(matrix_path, keep, out_path):
+    # Rewrites a Fortran-ordered matrix without its failed columns, one contiguous column at a time.
+    matrix = np.load(matrix_path, mmap_mode='r')
+    compacted = np.lib.format.open_memmap(out_path, mode='w+', dtype=matrix.dtype,
+                                          shape=(matrix.shape[0], int(keep.sum())), fortran_order=True)
+    for new_column, column in enumerate(np.flatnonzero(keep)):
+        compacted[:, new_column] = matrix[:, column]
+    compacted.flush()
+    del compacted, matrix
+
+def columns_manifest_path(out_file):
+    return out_file[:-len('.npy')] + '_columns.csv'
+
+def load_study_hashes(type_path):
+    # Montage hashes recorded by simFromCSV_step1.py; studies simulated before it kept a manifest have none.
+    manifest_path = os.path.join(type_path, 'simulated_studies.csv')
+    if not os.path.exists(manifest_path):
+        return {}
+    manifest = pd.read_csv(manifest_path, dtype=str, keep_default_na=False)
+    return dict(zip(manifest['Name'], manifest['MontageHash']))
+
+def load_columns(out_file):
+    # (study, mesh file name) -> (column, montage hash) of an existing matrix.
+    manifest_path = columns_manifest_path(out_file)
+    if not os.path.exists(manifest_path) or not os.path.exists(out_file):
+        return {}
+    columns = pd.read_csv(manifest_path, dtype=str, keep_default_na=False)
+    return {(name, file): (column, montage) for column, (name, file, montage)
+            in enumerate(zip(columns['Name'], columns['File'], columns['MontageHash']))}
+
+def create_matrices_totales(type_path, output_files, n_workers=4, verbose=False, update=False):
+    # Single pass over the studies of one type: a process pool reads each study once and the columns of
+    # all variants go straight into preallocated .npy memmaps, so no variant is ever held in a list or
+    # stacked in memory. With update, columns whose study and montage hash are unchanged are taken from the
+    # existing matrices and only new or re-simulated studies are read. Returns, per variant, whether its
+    # matrix was written.
+    if verbose:
+        print(f"Starting to process mesh files in {type_path}...")
+    try:
+        study_meshes = find_study_meshes(type_path, verbose, list(output_files))
+    except Exception as e:
+        print(f"Error listing directory {type_path}: {e}")
+        return {variant: False for variant in output_files}
+    hashes = load_study_hashes(type_path)
+
+    # Column layout: one column per mesh file, in study order.
+    layout = {variant: [] for variant in output_files}
+    for study, meshes in study_meshes:
+        for variant, files in meshes.items():
+            layout[variant].extend((study, file) for file in files)
+    column_of = {variant: {file: column for column, (_, file) in enumerate(layout[variant])} for variant in output_files}
+
+    # Source column in the existing matrix, or -1 when the mesh has to be read.
+    reuse = {}
+    for variant in output_files:
+        previous = load_columns(output_files[variant]) if update else {}
+        reuse[variant] = np.full(len(layout[variant]), -1, dtype=np.int64)
+        for column, (study, file) in enumerate(layout[variant]):
+            old = previous.get((study, os.path.basename(file)))
+            if old is not None and old[1] and old[1] == hashes.get(study, ''):
+                reuse[variant][column] = old[0]
+
+    part_paths = {variant: output_files[variant][:-len('.npy')] + '_part.npy' for variant in output_files}
+    matrices = {variant: None for variant in output_files}
+    in_place = {variant: False for variant in output_files}
+    written = {variant: reuse[variant] >= 0 for variant in output_files}
+    for variant in output_files:
+        kept = np.flatnonzero(reuse[variant] >= 0)
+        if kept.shape[0] == 0:
             continue
+        old_matrix = np.load(output_files[variant], mmap_mode='r')
+        if (old_matrix.flags.f_contiguous and old_matrix.shape[1] == len(layout[variant])
+                and np.array_equal(reuse[variant][kept], kept)):
+            # Same columns in the same places: only the re-simulated studies are overwritten.
+            del old_matrix
+            matrices[variant] = np.load(output_files[variant], mmap_mode='r+')
+            in_place[variant] = True
+            continue
+        matrices[variant] = np.lib.format.open_memmap(
+            part_paths[variant], mode='w+', dtype=old_matrix.dtype,
+            shape=(old_matrix.shape[0], len(layout[variant])), fortran_order=True)
+        for column in kept:
+            matrices[variant][:, column] = old_matrix[:, reuse[variant][column]]
+        del old_matrix
 
-        found_files = glob.glob(pattern)
-        if not found_files:
+    tasks = []
+    for study, meshes in study_meshes:
+        pending = {variant: [file for file in files if reuse[variant][column_of[variant][file]] < 0]
+                   for variant, files in meshes.items()}
+        if any(pending.values()):
+            tasks.append((study, pending, verbose))
+    if update:
+        print(f"Reading {len(tasks)} new or changed studies in {type_path}")
+    with multiprocessing.Pool(n_workers) as pool:
+        for study, columns, remove_dirs in pool.imap(extract_study, tasks):
+            for remove_dir in remove_dirs:
+                shutil.rmtree(remove_dir, ignore_errors=True)
+            for variant, file_columns in columns.items():
+                for file, field_data in file_columns:
+                    if field_data is None:
+                        continue
+                    if matrices[variant] is None:
+                        # Fortran order keeps every study column contiguous on disk.
+                        matrices[variant] = np.lib.format.open_memmap(
+                            part_paths[variant], mode='w+', dtype=field_data.dtype,
+                            shape=(field_data.shape[0], len(column_of[variant])), fortran_order=True)
+                    if field_data.shape[0] != matrices[variant].shape[0]:
+                        print(f"Error stacking fields: {file} has {field_data.shape[0]} values, "
+                              f"expected {matrices[variant].shape[0]}. Skipping this file.")
+                        continue
+                    matrices[variant][:, column_of[variant][file]] = field_data
+                    written[variant][column_of[variant][file]] = True
             if verbose:
-                print(f"No .msh files found in {search_folder}. Skipping and deleting...")
-            shutil.rmtree(type_path)
+                print(f"Extracted study {study}")
+
+    success = {}
+    for variant, out_file in output_files.items():
+        matrix = matrices[variant]
+        if matrix is None:
+            print(f"No valid field data extracted from mesh files in {type_path} (overlay: {VARIANTS[variant][0]}).")
+            success[variant] = False
             continue
+        matrix.flush()
+        del matrix
+        matrices[variant] = None
+        if in_place[variant]:
+            if not written[variant].all():
+                drop_columns(out_file, written[variant], part_paths[variant])
+                os.replace(part_paths[variant], out_file)
+        elif written[variant].all():
+            os.replace(part_paths[variant], out_file)
         else:
-            if verbose:
-                print(f"Found {len(found_files)} .msh files in {search_folder}.")
-            mesh_files.extend(found_files)
+            drop_columns(part_paths[variant], written[variant], out_file)
+            os.remove(part_paths[variant])
+        columns = [(study, os.path.basename(file), hashes.get(study, ''))
+                   for (study, file), ok in zip(layout[variant], written[variant]) if ok]
+        manifest_path = columns_manifest_path(out_file)
+        pd.DataFrame(columns, columns=['Name', 'File', 'MontageHash']).to_csv(manifest_path + '.tmp', index=False)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        if verbose:
+            print(f"Finished {int(written[variant].sum())} mesh files in {type_path} (overlay: {VARIANTS[variant][0]}).")
+        success[variant] = True
+    return success
 
-    if not mesh_files:
-        print(f"No mesh files found in {mesh_dir} with overlay_subfolder='{overlay_subfolder}'.")
-        return None
+def file_hash(path, chunkSize=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunkSize), b''):
+            h.update(block)
+    return h.hexdigest()
 
-    try:
-        mesh_files = sorted(
-            mesh_files,
-            key=lambda x: int(os.path.basename(x).split('_')[-2])
-        )
-    except (IndexError, ValueError) as e:
-        if verbose:
-            print(f"Warning: Could not sort mesh files as expected. Sorting alphabetically. Error: {e}")
-        mesh_files = sorted(mesh_files)
+def read_surface(path):
+    import nibabel as nib
 
-    for file in mesh_files:
-        if verbose:
-            print(f"Processing {file}...")
-        
-        try:
-            mesh = simnibs.read_msh(file)
-        except Exception as e:
-            print(f"Error reading {file}: {e}. Skipping this file.")
-            shutil.rmtree(os.path.dirname(file))
-            continue
+    coords, triangles = nib.load(path).agg_data(('pointset', 'triangle'))
+    return np.asarray(coords, dtype=np.float64), np.asarray(triangles, dtype=np.int64)
 
-        if overlay_subfolder is None:
-            print(overlay_subfolder)
-            try:
-                gray_matter = mesh.crop_mesh(2)
-            except KeyError:
-                print(f"Label 2 (gray matter) not found in {file}. Skipping this file.")
-                continue
+def volume_to_surface_operator(gray_matter, points):
+    # Linear map from grey matter element values to values at points, interpolated the way SimNIBS does
+    # for element fields: element-to-node averaging, then barycentric weights inside the tetrahedron that
+    # holds each point. Points outside the grey matter take the value of the nearest element.
+    elm2node = scipy.sparse.csr_matrix(gray_matter.elm2node_matrix())
+    tetrahedra, barycentric = gray_matter.find_tetrahedron_with_points(points, compute_baricentric=True)
+    inside = tetrahedra > 0
+    nodes = gray_matter.elm.node_number_list[tetrahedra[inside] - 1] - 1
+    rows = np.repeat(np.flatnonzero(inside), 4)
+    to_nodes = scipy.sparse.csr_matrix((barycentric[inside].ravel(), (rows, nodes.ravel())),
+                                       shape=(points.shape[0], elm2node.shape[0]))
+    operator = to_nodes @ elm2node
+    outside = np.flatnonzero(~inside)
+    if outside.shape[0] > 0:
+        nearest = cKDTree(gray_matter.elements_baricenters()[:]).query(points[outside])[1]
+        operator = operator + scipy.sparse.csr_matrix((np.ones(outside.shape[0]), (outside, nearest)), shape=operator.shape)
+    return operator.tocsr()
 
-            try:
-                field_data = gray_matter.field['magnE'][:]
-            except KeyError:
-                print(f"'magnE' field not found in {file}. Skipping this file.")
-                continue
-        else:
-            try:
-                field_data = mesh.field['E_magn'][:]
-            except KeyError:
-                print(f"'E_magn' field not found in {file}. Skipping this file.")
-                continue
+def sphere_interpolation_operator(source_nodes, source_triangles, target_points, candidates=8):
+    # Barycentric interpolation between registered spheres: each target point takes the values of the
+    # source triangle hit by the ray from the centre through it, searched among the nearest triangles.
+    # Points whose ray misses all candidates are searched again with four times as many.
+    source = source_nodes / np.linalg.norm(source_nodes, axis=1, keepdims=True)
+    direction = target_points / np.linalg.norm(target_points, axis=1, keepdims=True)
+    centroids = cKDTree(source[source_triangles].mean(axis=1))
+    weights = np.zeros((direction.shape[0], 3))
+    triangles = np.zeros(direction.shape[0], dtype=np.int64)
+    pending = np.arange(direction.shape[0])
+    while pending.size:
+        k = min(candidates, source_triangles.shape[0])
+        candidate = centroids.query(direction[pending], k=k)[1].reshape(pending.size, k)
+        corners = source[source_triangles[candidate]]
+        a, edge1, edge2 = corners[:, :, 0], corners[:, :, 1] - corners[:, :, 0], corners[:, :, 2] - corners[:, :, 0]
+        d = direction[pending, None, :]
+        p = np.cross(d, edge2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_det = 1.0 / np.sum(edge1 * p, axis=2)
+            u = np.sum(-a * p, axis=2) * inv_det
+            v = np.sum(d * np.cross(-a, edge1), axis=2) * inv_det
+        bary = np.nan_to_num(np.stack([1.0 - u - v, u, v], axis=2), nan=-np.inf)
+        best = np.argmax(bary.min(axis=2), axis=1)
+        rows = np.arange(pending.size)
+        weights[pending] = bary[rows, best]
+        triangles[pending] = candidate[rows, best]
+        if k == source_triangles.shape[0]:
+            break
+        pending = pending[weights[pending].min(axis=1) < -1e-9]
+        candidates *= 4
+    weights = np.clip(weights, 0.0, None)
+    weights /= weights.sum(axis=1, keepdims=True)
+    rows = np.repeat(np.arange(direction.shape[0]), 3)
+    return scipy.sparse.csr_matrix((weights.ravel(), (rows, source_triangles[triangles].ravel())),
+                                   shape=(direction.shape[0], source_nodes.shape[0]))
 
-        fields.append(field_data)
+OVERLAY_VARIANTS = ('subject_overlays', 'fsavg_overlays')
 
-    if not fields:
-        print("No valid field data extracted from mesh files.")
-        return None
+def overlay_operators(subpath, cacheDir):
+    # Sparse operators from the grey matter elements (rows of matrice_totale_base) to the nodes of the
+    # subject central surface and of fsaverage, left then right hemisphere as in the SimNIBS overlays.
+    # They depend only on the subject geometry and are cached next to it, keyed by the hashes of their inputs.
+    from simnibs.utils import file_finder
 
-    try:
-        matrice_totale = np.column_stack(fields)
-    except ValueError as e:
-        print(f"Error stacking fields: {e}")
-        return None
+    subject_name = os.path.basename(os.path.normpath(subpath)).split('m2m_')[-1]
+    head_mesh = os.path.join(subpath, f'{subject_name}.msh')
+    surfaces = {hemi: {kind: os.path.join(subpath, 'surfaces', f'{hemi}.{kind}.gii') for kind in ('central', 'sphere.reg')}
+                for hemi in ('lh', 'rh')}
+    references = {hemi: file_finder.get_reference_surf(hemi, 'sphere') for hemi in ('lh', 'rh')}
+    inputs = [head_mesh] + [surfaces[hemi][kind] for hemi in surfaces for kind in surfaces[hemi]] + list(references.values())
+    key = hashlib.sha1(''.join(file_hash(path) for path in inputs).encode('utf-8')).hexdigest()[:16]
+    paths = {variant: os.path.join(cacheDir, f'{variant}_{key}.npz') for variant in OVERLAY_VARIANTS}
+    if all(os.path.exists(path) for path in paths.values()):
+        return {variant: scipy.sparse.load_npz(path).tocsr() for variant, path in paths.items()}
 
-    if verbose:
-        print(f"Finished processing {len(mesh_files)} mesh files in {mesh_dir} (overlay: {overlay_subfolder}).")
-    return matrice_totale
+    gray_matter = simnibs.read_msh(head_mesh).crop_mesh(2)
+    rows = {variant: [] for variant in OVERLAY_VARIANTS}
+    for hemi in ('lh', 'rh'):
+        central, _ = read_surface(surfaces[hemi]['central'])
+        sphere, sphere_triangles = read_surface(surfaces[hemi]['sphere.reg'])
+        reference, _ = read_surface(references[hemi])
+        to_surface = volume_to_surface_operator(gray_matter, central)
+        rows['subject_overlays'].append(to_surface)
+        rows['fsavg_overlays'].append(sphere_interpolation_operator(sphere, sphere_triangles, reference) @ to_surface)
+    os.makedirs(cacheDir, exist_ok=True)
+    operators = {}
+    for variant in OVERLAY_VARIANTS:
+        operators[variant] = scipy.sparse.vstack(rows[variant]).tocsr()
+        tmp_path = paths[variant][:-len('.npz')] + '_part.npz'
+        scipy.sparse.save_npz(tmp_path, operators[variant])
+        os.replace(tmp_path, paths[variant])
+    return operators
 
-if __name__ == '__main__':
+def map_overlay_matrices(base_file, operators, output_files, columnBlock=16):
+    # Overlay matrices of all studies as operator x base, streamed over blocks of study columns.
+    base = np.load(base_file, mmap_mode='r')
+    for variant, operator in operators.items():
+        if operator.shape[1] != base.shape[0]:
+            raise ValueError(f"The {variant} operator maps {operator.shape[1]} elements, {base_file} has {base.shape[0]} rows")
+        part_path = output_files[variant][:-len('.npy')] + '_part.npy'
+        overlay = np.lib.format.open_memmap(part_path, mode='w+', dtype=base.dtype,
+                                            shape=(operator.shape[0], base.shape[1]), fortran_order=True)
+        for column_start in range(0, base.shape[1], columnBlock):
+            column_end = min(column_start + columnBlock, base.shape[1])
+            overlay[:, column_start:column_end] = operator @ np.asarray(base[:, column_start:column_end], dtype=np.float64)
+        overlay.flush()
+        del overlay
+        os.replace(part_path, output_files[variant])
+        shutil.copyfile(columns_manifest_path(base_file), columns_manifest_path(output_files[variant]))
+    del base
+
+def main(argv=None):
     import argparse
 
     parser = argparse.ArgumentParser(description="Transform Mesh Files to NPY matrices")
     parser.add_argument("subpath", help="Path to the subject's mesh directory.")
-    args = parser.parse_args()
+    parser.add_argument("--workers", type=int, default=4, help="Number of studies read in parallel.")
+    parser.add_argument("--update", action="store_true",
+                        help="Keep the columns of unchanged studies and only read new or re-simulated ones.")
+    parser.add_argument("--map-overlays", action="store_true",
+                        help="Build the overlay matrices from the base matrix with cached surface operators "
+                             "instead of reading the SimNIBS overlay meshes.")
+    parser.add_argument("--types", nargs='+', default=['ToM', 'Altruism', 'Empathy'],
+                        help="Attribute types to extract.")
+    args = parser.parse_args(argv)
 
     base_path = os.path.join(args.subpath, 'allMeshes')
-    subfolders = ['ToM', 'Altruism', 'Empathy']
+    subfolders = args.types
 
     verbose = True
     if verbose:
@@ -139,21 +610,34 @@ if __name__ == '__main__':
             'subject_overlays': os.path.join(subfolder_path, f'{subfolder}_matrice_totale_subject_overlays.npy'),
         }
 
-        for overlay_key, out_file in output_files.items():
-            if verbose:
-                print(f"\nProcessing subfolder: {subfolder} with overlay type: {overlay_key}")
-
-            if overlay_key == 'base':
-                overlay = None  
-            else:
-                overlay = overlay_key  # either 'fsavg_overlays' or 'subject_overlays'
-            
-            matrice_totale = create_matrice_totale(subfolder_path, overlay_subfolder=overlay, verbose=verbose)
-            if matrice_totale is not None:
-                np.save(out_file, matrice_totale)
+        if verbose:
+            print(f"\nProcessing subfolder: {subfolder}")
+        read_files = {'base': output_files['base']} if args.map_overlays else output_files
+        expected = output_files
+        if not args.map_overlays and has_leadfield_studies(subfolder_path):
+            # Lead-field studies only store their grey matter field, so overlay matrices read from the meshes
+            # would miss their columns and fall out of step with the base matrix.
+            print(f"{subfolder} has lead-field studies: skipping the overlays (--map-overlays builds them "
+                  f"from the base matrix).")
+            read_files = expected = {'base': output_files['base']}
+            for variant in OVERLAY_VARIANTS:
+                for stale_path in (output_files[variant], columns_manifest_path(output_files[variant])):
+                    if os.path.exists(stale_path):
+                        os.remove(stale_path)
+        success = create_matrices_totales(subfolder_path, read_files, n_workers=args.workers, verbose=verbose,
+                                          update=args.update)
+        if args.map_overlays and success['base']:
+            operators = overlay_operators(args.subpath, os.path.join(args.subpath, 'overlay_operators'))
+            map_overlay_matrices(output_files['base'], operators, output_files)
+            success.update({variant: True for variant in OVERLAY_VARIANTS})
+        for overlay_key, out_file in expected.items():
+            if success.get(overlay_key):
                 if verbose:
                     print(f"Saved matrice_totale ({overlay_key}) to {out_file}")
             else:
                 error_message = f"Failed to create matrice_totale for {subfolder} with overlay type '{overlay_key}'."
                 print(error_message)
                 raise RuntimeError(error_message)
+
+if __name__ == '__main__':
+    main()
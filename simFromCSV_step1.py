@@ -3,6 +3,15 @@ import pandas as pd
 import os
 import concurrent.futures
 import sys
+import hashlib
+import shutil
+import glob
+import numpy as np
+
+# Columns of allData.csv that define what run_simulation_for_study simulates.
+MONTAGE_COLUMNS = ['mA', 'aLocation', 'aSize', 'Shape', 'aThickness', 'aY', 'aHole',
+                   'cLocation', 'cSize', 'cThickness', 'cY', 'cHole']
+MANIFEST_NAME = 'simulated_studies.csv'
 
 def addElectrode(tdcsList, electrodeLocation, electrodeSize, electrodeShape, electrodeThickness, electrodeYdir, electrodeHole, channelType):
     # channelnr : 1 = cathode, 2 = anode
@@ -62,30 +71,211 @@ def run_simulation_for_type(attr_type, df, base_path, subpath, eeg_cap):
 
     run_simnibs(s, n_proc=16)
 
-def run_simulation_for_study(study, base_path, subpath, eeg_cap):
-    import simnibs
+def montage_hash(study):
+    values = []
+    for column in MONTAGE_COLUMNS:
+        value = study[column]
+        values.append('' if pd.isna(value) else str(value).strip())
+    return hashlib.sha1('|'.join(values).encode('utf-8')).hexdigest()
+
+def load_manifest(base_path, attr_type):
+    # Name -> montage hash of the studies already simulated for one type.
+    manifest_path = os.path.join(base_path, attr_type, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    manifest = pd.read_csv(manifest_path, dtype=str, keep_default_na=False)
+    return dict(zip(manifest['Name'], manifest['MontageHash']))
+
+def save_manifest(base_path, attr_type, manifest):
+    manifest_path = os.path.join(base_path, attr_type, MANIFEST_NAME)
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    tmp_path = manifest_path + '.tmp'
+    pd.DataFrame(sorted(manifest.items()), columns=['Name', 'MontageHash']).to_csv(tmp_path, index=False)
+    os.replace(tmp_path, manifest_path)
+
+def select_changed_studies(filtered_df, base_path, listAttributeTypes):
+    # Diff against the manifests: studies that are new or whose montage changed are returned for simulation
+    # (their stale outputs are removed first), studies no longer in the CSV are deleted.
+    latest = filtered_df.drop_duplicates(['Type', 'Name'], keep='last')
+    studies = []
+    for attr_type in listAttributeTypes:
+        manifest = load_manifest(base_path, attr_type)
+        type_studies = latest[latest['Type'] == attr_type].to_dict('records')
+        for study in type_studies:
+            if manifest.get(study['Name']) == montage_hash(study):
+                continue
+            shutil.rmtree(os.path.join(base_path, attr_type, study['Name']), ignore_errors=True)
+            manifest.pop(study['Name'], None)
+            studies.append(study)
+        current_names = {study['Name'] for study in type_studies}
+        for name in [name for name in manifest if name not in current_names]:
+            print(f"Study {name} is no longer in the CSV for {attr_type}. Removing it.")
+            shutil.rmtree(os.path.join(base_path, attr_type, name), ignore_errors=True)
+            del manifest[name]
+        save_manifest(base_path, attr_type, manifest)
+    return studies
+
+def electrode_geometry(electrodeSize, electrodeShape, electrodeThickness):
+    try:
+        thickness = float(electrodeThickness)
+    except (TypeError, ValueError):
+        thickness = str(electrodeThickness).strip()
+    return tuple(int(x) for x in electrodeSize.split('x')), electrodeShape.strip(), thickness
+
+def parse_electrodes(electrodeLocation, electrodeSize, electrodeShape, electrodeThickness, electrodeHole, channelType):
+    # Canonical form of the electrodes addElectrode builds from one side of a montage.
+    if ',' in electrodeLocation:
+        try:
+            centres = [tuple(round(float(x), 6) for x in electrodeLocation.split(','))]
+        except ValueError:
+            centres = [x.strip() for x in electrodeLocation.split(',')]
+    else:
+        centres = [electrodeLocation.strip()]
+    geometry = electrode_geometry(electrodeSize, electrodeShape, electrodeThickness)
+    hole = None if pd.isna(electrodeHole) else tuple(int(x) for x in electrodeHole.split('x'))
+    return [repr((channelType, centre) + geometry + (hole,)) for centre in centres]
+
+def montage_fingerprint(study):
+    # Identifies the electrode geometry of a study independently of its current: fields are linear in
+    # the current, so studies with the same fingerprint differ only by a factor mA.
+    electrodes = (parse_electrodes(study['aLocation'], study['aSize'], study['Shape'], study['aThickness'], study['aHole'], "anode")
+                  + parse_electrodes(study['cLocation'], study['cSize'], study['Shape'], study['cThickness'], study['cHole'], "cathode"))
+    return hashlib.sha1('|'.join(sorted(electrodes)).encode('utf-8')).hexdigest()
+
+def solve_study(study, output_dir, subpath, eeg_cap, mA, map_surfaces=True, cpus=16):
     from simnibs import sim_struct, run_simnibs
-    import os
 
-    output_dir = os.path.join(base_path, study['Type'], study['Name'])
     os.makedirs(output_dir, exist_ok=True)
-
     s = sim_struct.SESSION()
     s.subpath = subpath
     s.pathfem = output_dir
     s.eeg_cap = eeg_cap
     s.open_in_gmsh = False
-    s.map_to_fsavg = True 
-    s.map_to_surf = True 
+    s.map_to_fsavg = map_surfaces
+    s.map_to_surf = map_surfaces
     tdcslist = s.add_tdcslist()
-    tdcslist.currents = [-study['mA'] * 1e-3, study['mA'] * 1e-3]
+    tdcslist.currents = [-mA * 1e-3, mA * 1e-3]
     tdcslist = addElectrode(tdcslist, study['aLocation'], study['aSize'], study['Shape'], study['aThickness'], study['aY'], study['aHole'], "anode")
     tdcslist = addElectrode(tdcslist, study['cLocation'], study['cSize'], study['Shape'], study['cThickness'], study['cY'], study['cHole'], "cathode")
 
-    run_simnibs(s, cpus=16)
+    run_simnibs(s, cpus=cpus)
 
+# Output fields that are linear in the injected current: potential, fields and current densities with their
+# magnitudes and surface components. Anything else (conductivity, E_angle, ...) is copied as it is.
+SCALED_FIELDS = ('v', 'E', 'magnE', 'J', 'magnJ', 'E_magn', 'E_normal', 'E_tangent', 'J_magn', 'J_normal', 'J_tangent')
 
-if __name__ == '__main__':
+def rescale_outputs(reference_dir, output_dir, scale):
+    # Copies a solve done at 1 mA, multiplying the current-linear fields of its meshes (head mesh and surface
+    # overlays) by scale.
+    from simnibs import read_msh
+
+    for root, _, files in os.walk(reference_dir):
+        target_root = os.path.join(output_dir, os.path.relpath(root, reference_dir))
+        os.makedirs(target_root, exist_ok=True)
+        for name in files:
+            source = os.path.join(root, name)
+            target = os.path.join(target_root, name)
+            if not name.endswith('.msh') or scale == 1:
+                shutil.copy2(source, target)
+                continue
+            mesh = read_msh(source)
+            for data in mesh.nodedata + mesh.elmdata:
+                if data.field_name in SCALED_FIELDS:
+                    data.value = data.value * scale
+            mesh.write(target)
+
+# Dataset of the E-field lead field in the hdf5 file written by TDCSLEADFIELD.
+LEADFIELD_DATASET = 'mesh_leadfield/leadfields/tdcs_leadfield'
+LEADFIELD_OUTPUT = 'leadfield_magnE_gm.npy'
+
+def electrode_class(study):
+    # Lead-field class (shape, size, thickness) of a montage made of one plain cap electrode per channel,
+    # or None when the montage needs a full solve: holes, coordinates, several electrodes per channel or
+    # two different electrodes.
+    if not (pd.isna(study['aHole']) and pd.isna(study['cHole'])):
+        return None
+    if ',' in str(study['aLocation']) or ',' in str(study['cLocation']):
+        return None
+    geometry = electrode_geometry(study['aSize'], study['Shape'], study['aThickness'])
+    if geometry != electrode_geometry(study['cSize'], study['Shape'], study['cThickness']):
+        return None
+    return hashlib.sha1(repr(geometry).encode('utf-8')).hexdigest()
+
+def leadfield_for_class(study, leadfield_dir, subpath, eeg_cap, cpus=16):
+    # One TDCSLEADFIELD run per electrode class and subject, evaluated at the grey matter elements (tag 2)
+    # in mesh order, the rows of matrice_totale_base.
+    from simnibs import sim_struct, run_simnibs
+
+    class_dir = os.path.join(leadfield_dir, electrode_class(study))
+    found = glob.glob(os.path.join(class_dir, '*.hdf5'))
+    if not found:
+        tmp_dir = class_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        lf = sim_struct.TDCSLEADFIELD()
+        lf.subpath = subpath
+        lf.pathfem = tmp_dir
+        lf.eeg_cap = eeg_cap
+        lf.current = 1e-3
+        lf.electrode.shape = study['Shape']
+        lf.electrode.dimensions = [int(x) for x in study['aSize'].split('x')]
+        lf.electrode.thickness = study['aThickness']
+        lf.tissues = [2]
+        lf.interpolation = None
+        run_simnibs(lf, cpus=cpus)
+        os.replace(tmp_dir, class_dir)
+        found = glob.glob(os.path.join(class_dir, '*.hdf5'))
+    return found[0]
+
+def superpose_leadfield(leadfield_path, anode, cathode, mA):
+    # Field of a bipolar montage from the 1 mA lead fields against the reference electrode:
+    # E = mA * (L_anode - L_cathode), with L_reference = 0. Returns magnE, or None for unknown positions.
+    import h5py
+
+    with h5py.File(leadfield_path, 'r') as f:
+        leadfield = f[LEADFIELD_DATASET]
+        names = [n.decode() if isinstance(n, bytes) else str(n) for n in leadfield.attrs['electrode_names']]
+        reference = leadfield.attrs['reference_electrode']
+        reference = reference.decode() if isinstance(reference, bytes) else str(reference)
+        rows = names if len(names) == leadfield.shape[0] else [n for n in names if n != reference]
+        if any(label != reference and label not in rows for label in (anode, cathode)):
+            return None
+        field = np.zeros(leadfield.shape[1:], dtype=np.float64)
+        if anode != reference:
+            field += leadfield[rows.index(anode)]
+        if cathode != reference:
+            field -= leadfield[rows.index(cathode)]
+    return np.linalg.norm(mA * field, axis=1)
+
+def run_simulation_for_study(study, base_path, subpath, eeg_cap, cache_dir=None, leadfield_dir=None, map_surfaces=True,
+                             cpus=16):
+    output_dir = os.path.join(base_path, study['Type'], study['Name'])
+    mA = float(study['mA'])
+    if leadfield_dir is not None and electrode_class(study) is not None:
+        leadfield_path = leadfield_for_class(study, leadfield_dir, subpath, eeg_cap, cpus)
+        magnE = superpose_leadfield(leadfield_path, study['aLocation'].strip(), study['cLocation'].strip(), mA)
+        if magnE is not None:
+            # Only the grey matter field is produced; meshToNpy_step2.py reads it as the base column.
+            os.makedirs(output_dir, exist_ok=True)
+            np.save(os.path.join(output_dir, LEADFIELD_OUTPUT), magnE.astype(np.float32))
+            return
+        print(f"Electrodes of study {study['Name']} are not in the lead field. Running a full solve.")
+    if cache_dir is None or not mA > 0:
+        solve_study(study, output_dir, subpath, eeg_cap, mA, map_surfaces, cpus)
+        return
+
+    # Montage cache of the subject, shared by all types: each electrode geometry is solved once at 1 mA.
+    reference_dir = os.path.join(cache_dir, montage_fingerprint(study) + ('' if map_surfaces else '_volume'))
+    if not os.path.isdir(reference_dir):
+        tmp_dir = reference_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        solve_study(study, tmp_dir, subpath, eeg_cap, 1.0, map_surfaces, cpus)
+        os.replace(tmp_dir, reference_dir)
+    else:
+        print(f"Reusing the solve of montage {os.path.basename(reference_dir)} for study {study['Name']}")
+    rescale_outputs(reference_dir, output_dir, mA)
+
+
+def main(argv=None):
     import argparse
     import pandas as pd
     import os
@@ -95,22 +285,43 @@ if __name__ == '__main__':
     parser.add_argument("subpath", help="Path to the subject's mesh directory.")
     parser.add_argument("eeg_cap", help="Path to the EEG cap positions file.")
     parser.add_argument("data_filepath", help="Path to the CSV data file.")
-    args = parser.parse_args()
+    parser.add_argument("--no-montage-cache", action="store_true",
+                        help="Solve every study, even when another study used the same electrode montage.")
+    parser.add_argument("--leadfield", action="store_true",
+                        help="Build plain bipolar cap montages from per-subject lead fields instead of solving them.")
+    parser.add_argument("--no-surface-mapping", action="store_true",
+                        help="Skip the per-study surface and fsaverage overlays; meshToNpy_step2.py --map-overlays "
+                             "builds them for all studies at once.")
+    parser.add_argument("--update", action="store_true",
+                        help="Only simulate studies that are new or whose montage changed since the last run.")
+    parser.add_argument("--cpus", type=int, default=16, help="Cores given to each SimNIBS solve.")
+    parser.add_argument("--types", nargs='+', default=['ToM', 'Altruism', 'Empathy'],
+                        help="Attribute types to simulate.")
+    args = parser.parse_args(argv)
 
     df = pd.read_csv(args.data_filepath)
 
-    listAttributeTypes = ['ToM', 'Altruism', 'Empathy']
+    listAttributeTypes = args.types
     base_path = os.path.join(args.subpath, 'allMeshes')
 
     filtered_df = df[df['Type'].isin(listAttributeTypes)]
 
-    studies = filtered_df.to_dict('records')
+    if args.update:
+        studies = select_changed_studies(filtered_df, base_path, listAttributeTypes)
+        print(f"{len(studies)} new or changed studies to simulate")
+    else:
+        studies = filtered_df.to_dict('records')
+    manifests = {attr_type: load_manifest(base_path, attr_type) for attr_type in listAttributeTypes}
 
     max_workers = 1
+    cache_dir = None if args.no_montage_cache else os.path.join(args.subpath, 'montage_cache')
+    leadfield_dir = os.path.join(args.subpath, 'leadfields') if args.leadfield else None
 
+    failed = []
     with ProcessPoolExecutor(max_workers=max_workers) as executor:
         future_to_study = {
-            executor.submit(run_simulation_for_study, study, base_path, args.subpath, args.eeg_cap): study
+            executor.submit(run_simulation_for_study, study, base_path, args.subpath, args.eeg_cap, cache_dir, leadfield_dir,
+                            not args.no_surface_mapping, args.cpus): study
             for study in studies
         }
 
@@ -119,5 +330,17 @@ if __name__ == '__main__':
             try:
                 future.result()
                 print(f"Simulation completed for study: {study['Name']}")
+                manifests[study['Type']][study['Name']] = montage_hash(study)
+                save_manifest(base_path, study['Type'], manifests[study['Type']])
             except Exception as exc:
-                print(f"Simulation generated an exception for study {study['Name']}: {exc}")
\ No newline at end of file
+                print(f"Simulation generated an exception for study {study['Name']}: {exc}")
+                failed.append(study['Name'])
+
+    if failed:
+        # Failed studies are left out of the manifest, so a rerun with --update retries only them.
+        print(f"{len(failed)} studies failed: {', '.join(failed)}")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
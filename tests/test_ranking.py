@@ -0,0 +1,49 @@
+import os
+import sys
+import numpy as np
+import pytest
+import scipy.stats
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Do_Corr_Percentiles_GenMesh_345 as corr
+
+def reference_ranks(data):
+    return scipy.stats.rankdata(data, method='average', axis=1)
+
+def test_rankdata_average_matches_scipy_with_ties():
+    rng = np.random.default_rng(0)
+    # Few distinct values, so most rows hold several tie groups of different sizes.
+    data = rng.integers(0, 4, size=(200, 15)).astype(np.float32)
+    np.testing.assert_array_equal(corr.rankdata_average(data), reference_ranks(data))
+
+def test_rankdata_average_matches_scipy_without_ties():
+    data = np.random.default_rng(1).normal(size=(100, 23)).astype(np.float32)
+    np.testing.assert_array_equal(corr.rankdata_average(data), reference_ranks(data))
+
+def test_rankdata_average_constant_rows():
+    data = np.zeros((5, 9), dtype=np.float32)
+    data[2] = 3.5
+    ranks = corr.rankdata_average(data)
+    np.testing.assert_array_equal(ranks, reference_ranks(data))
+    np.testing.assert_array_equal(ranks, np.full((5, 9), 5.0))
+
+def test_rankdata_average_one_dimensional():
+    x = np.array([3.0, 1.0, 3.0, 2.0, 1.0, 3.0], dtype=np.float32)
+    ranks = corr.rankdata_average(x)
+    assert ranks.shape == x.shape
+    np.testing.assert_array_equal(ranks, scipy.stats.rankdata(x, method='average'))
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, 65, 1000])
+def test_rankdata_average_chunk_boundaries(chunk_size):
+    data = np.random.default_rng(2).integers(0, 6, size=(130, 11)).astype(np.float32)
+    np.testing.assert_array_equal(corr.rankdata_average(data, chunkSize=chunk_size), reference_ranks(data))
+
+@pytest.mark.parametrize("row_chunk", [16, 65536])
+def test_gemm_spearman_matches_scipy(row_chunk):
+    rng = np.random.default_rng(3)
+    matrix = rng.normal(size=(60, 14)).astype(np.float32)
+    matrix[:20] = np.round(matrix[:20])  # tied rows
+    effect = rng.normal(size=14).astype(np.float32)
+    effect[:4] = effect[4]  # tied effect sizes
+    expected = [scipy.stats.spearmanr(row, effect)[0] for row in matrix]
+    np.testing.assert_allclose(corr.spearman_row(matrix, effect, rowChunk=row_chunk), expected, atol=1e-5)